@@ -7,7 +7,7 @@ import time
 import logging
 import traceback
 
-from mahjong_common import send_json, receive_json, sort_tiles, tile_sort_key
+from mahjong_common import send_json, receive_json, sort_tiles, tile_sort_key, ID_TO_TILE
 
 SERVER_HOST = '127.0.0.1'
 SERVER_PORT = 12345
@@ -27,6 +27,23 @@ TILE_TRANSLATION = {
 }
 
 
+def decode_state_tiles(state):
+    """game_state 中的牌以编号 (0-33) 发送，原地换回牌名，之后的显示和操作都使用牌名。"""
+    if not state:
+        return state
+    for p_state in state.get("players", []):
+        p_state["melds"] = [[ID_TO_TILE[t] for t in meld] for meld in p_state.get("melds", [])]
+        p_state["discarded"] = [ID_TO_TILE[t] for t in p_state.get("discarded", [])]
+        p_state["listening_tiles"] = [ID_TO_TILE[t] for t in p_state.get("listening_tiles", [])]
+    state["your_hand"] = [ID_TO_TILE[t] for t in state.get("your_hand", [])]
+    if state.get("last_discarded_tile") is not None:
+        state["last_discarded_tile"] = ID_TO_TILE[state["last_discarded_tile"]]
+    pending_action_info = state.get("pending_action_info")
+    if pending_action_info and pending_action_info.get("discarded_tile") is not None:
+        pending_action_info["discarded_tile"] = ID_TO_TILE[pending_action_info["discarded_tile"]]
+    return state
+
+
 def translate_tile(tile_str):
     return TILE_TRANSLATION.get(tile_str, tile_str)
 
@@ -66,13 +83,15 @@ class MahjongClient:
         port_str = input(f"请输入服务器端口 (默认: {SERVER_PORT}): ") or str(SERVER_PORT)
         try:
             port = int(port_str)
+            # 先输入名称再连接：服务器只等待连接请求 CONNECT_TIMEOUT 秒
+            player_name_input = input("请输入你的玩家名称: ")
+            self.player_name = player_name_input
+
             logger.info(f"尝试连接到服务器 {host}:{port}...")
             self.client_socket.connect((host, port))
             print(f"成功连接到服务器 {host}:{port}")
             logger.info(f"成功连接到服务器 {host}:{port}")
 
-            player_name_input = input("请输入你的玩家名称: ")
-            self.player_name = player_name_input
             send_json(self.client_socket, {"type": "connect", "player_name": self.player_name})
 
             self._receive_thread = threading.Thread(target=self.receive_messages, name="ReceiveThread", daemon=True)
@@ -148,7 +167,7 @@ class MahjongClient:
 
     def _handle_msg_game_state(self, message):
         logger.debug("收到游戏状态更新。")
-        self._current_game_state = message.get("state")
+        self._current_game_state = decode_state_tiles(message.get("state"))
         self.display_game_state()
 
     def _handle_msg_action_prompt(self, message):
@@ -157,6 +176,13 @@ class MahjongClient:
         self._pending_action_prompt = message
         self.display_game_state()
 
+    def _handle_msg_action_cancelled(self, message):
+        # 其他玩家已胡牌，服务器不再等待本玩家对弃牌的响应
+        if self._pending_action_prompt and self._pending_action_prompt.get("is_response_prompt"):
+            self._pending_action_prompt = None
+            print("\n*** 其他玩家已胡牌，本次响应已取消。 ***")
+        logger.info("响应提示被服务器取消。")
+
     def _handle_player_event_log(self, message, event_type_str):
         player_id = message.get("player_id")
         player_name = self.get_player_name(player_id)
@@ -231,6 +257,11 @@ class MahjongClient:
         print(f"\n*** 服务器错误: {error_msg} ***")
         logger.error(f"收到服务器错误: {error_msg}")
 
+    def _handle_msg_batch(self, message):
+        # 服务器把同一轮产生的多条消息合并为一帧发送，按顺序逐条处理
+        for sub_message in message.get("messages", []):
+            self.handle_server_message(sub_message)
+
     def _handle_unknown_message(self, message):
         logger.warning(f"收到未知消息类型: {message.get('type')}, 内容: {message}")
 
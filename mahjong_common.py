@@ -6,6 +6,11 @@ import socket
 import struct
 import logging
 
+try:
+    import orjson  # 可选依赖：编码/解码 JSON 比标准库 json 快数倍
+except ImportError:
+    orjson = None
+
 # 获取此模块的日志记录器
 logger = logging.getLogger(__name__)
 
@@ -21,39 +26,116 @@ ALL_TILES_SUIT = [f"{suit}_{point}" for suit in SUITS for point in POINTS]
 ALL_TILES_WIND = [f"feng_{wind}" for wind in WINDS]
 ALL_TILES_DRAGON = [f"jian_{dragon}" for dragon in DRAGONS]
 
+# 牌 <-> 整数编号 (0-33)，编号顺序与 tile_sort_key 的排序一致
+ID_TO_TILE = tuple(ALL_TILES_SUIT + ALL_TILES_WIND + ALL_TILES_DRAGON)
+TILE_TO_ID = {tile: i for i, tile in enumerate(ID_TO_TILE)}
+NUM_TILE_KINDS = len(ID_TO_TILE) # 34 种牌
+NUM_SUIT_KINDS = len(ALL_TILES_SUIT) # 编号小于此值的是万/条/筒，其余为字牌
+ALL_TILE_IDS = tuple(range(NUM_TILE_KINDS)) # 全部牌的编号
+SUIT_TILE_IDS = tuple(range(NUM_SUIT_KINDS)) # 不含风牌箭牌时的全部牌编号
+
 # 常量定义
 TILES_PER_TYPE = 4      # 每种牌有4张
 INITIAL_HAND_SIZE = 13 # 初始手牌数量
 # --- 常量结束 ---
 
 # --- 网络通信辅助函数 ---
+# 安装了 orjson 时用它编码/解码消息；设为 False 则始终使用标准库 json (输出带空格、便于调试时阅读)
+USE_ORJSON = orjson is not None
+
+def encode_json_bytes(data):
+    """将数据编码为JSON字节串（不带长度前缀），可交给 encode_batch_frame 合并成帧。"""
+    if USE_ORJSON:
+        return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(data).encode('utf-8')
+
+_LENGTH_PREFIX = struct.Struct('>I') # 无符号长整型（大端字节序）的长度前缀
+_BATCH_HEAD = b'{"type": "batch", "messages": ['
+_BATCH_TAIL = b']}'
+
+def _frame_bytes(data_bytes):
+    # 长度前缀与数据拼成一个缓冲区，sendall 一次写出，不会把前缀和数据拆成两个 TCP 段
+    return _LENGTH_PREFIX.pack(len(data_bytes)) + data_bytes
+
+def encode_json_frame(data):
+    """将数据编码为带4字节长度前缀（网络字节序）的JSON帧。广播时只需编码一次即可发给所有客户端。"""
+    return _frame_bytes(encode_json_bytes(data))
+
+def encode_batch_frame(encoded_messages):
+    """将多条已由 encode_json_bytes 编码的消息合并为一帧 {"type": "batch", "messages": [...]}。
+
+    只有一条消息时直接原样成帧。各条消息不再重新编码，同一广播消息的字节串可以在多个客户端的帧之间共用。
+    """
+    if len(encoded_messages) == 1:
+        return _frame_bytes(encoded_messages[0])
+    # 长度前缀、包装和各条消息在一次 join 中拼成整帧，不先拼出 batch 消息再复制一遍
+    body_length = len(_BATCH_HEAD) + len(_BATCH_TAIL) + sum(map(len, encoded_messages)) + 2 * (len(encoded_messages) - 1)
+    return b''.join((_LENGTH_PREFIX.pack(body_length), _BATCH_HEAD, b', '.join(encoded_messages), _BATCH_TAIL))
+
+def send_frame(sock, frame):
+    """发送已由 encode_json_frame 编码好的帧。"""
+    try:
+        sock.sendall(frame)
+    except Exception as e:
+        # 记录包含异常信息的错误日志
+        logger.exception("发送数据时发生错误 (send_frame)")
+        # 重新引发异常，让调用者处理（例如，断开连接）
+        raise
+
 def send_json(sock, data):
     """发送JSON数据，并在前面加上4字节的长度前缀（网络字节序）。"""
     try:
-        logger.debug(f"准备发送数据类型: {data.get('type')}") # 使用调试级别记录日志
-        data_bytes = json.dumps(data).encode('utf-8')
-        # 使用 struct.pack 将长度打包为无符号长整型（大端字节序）
-        length = struct.pack('>I', len(data_bytes))
+        logger.debug("准备发送数据类型: %s", data.get('type')) # 使用调试级别记录日志
         # 发送长度和数据
-        sock.sendall(length + data_bytes)
+        sock.sendall(encode_json_frame(data))
     except Exception as e:
         # 记录包含异常信息的错误日志
         logger.exception("发送数据时发生错误 (send_json)")
         # 重新引发异常，让调用者处理（例如，断开连接）
         raise
 
+def _recv_exact(sock, num_bytes):
+    """从 sock 读满 num_bytes 字节：直接 recv_into 预先分配的缓冲区，不反复拼接 bytes。连接在读满前关闭时返回 None。"""
+    buffer = bytearray(num_bytes)
+    view = memoryview(buffer)
+    received = 0
+    while received < num_bytes:
+        count = sock.recv_into(view[received:])
+        if not count:
+            return None
+        received += count
+    return buffer
+
+def _read_exact(rfile, num_bytes):
+    """从缓冲读取器读满 num_bytes 字节；BufferedReader.read 在 C 中合并多次 recv。连接在读满前关闭时返回 None。"""
+    data = rfile.read(num_bytes)
+    if data is None or len(data) < num_bytes:
+        return None
+    return data
+
 def receive_json(sock):
     """接收带长度前缀的JSON数据。"""
+    return _receive_message(sock, _recv_exact)
+
+def receive_frame(rfile):
+    """从 sock.makefile('rb') 得到的缓冲读取器接收带长度前缀的JSON数据。
+
+    多条小消息可由一次 recv 读入缓冲区，随后逐条取出，不必每条消息都进入内核。
+    """
+    return _receive_message(rfile, _read_exact)
+
+def _receive_message(source, read_exact):
+    """receive_json / receive_frame 的共同实现：read_exact(source, n) 读满 n 字节或返回 None。"""
     try:
-        # 首先接收4字节的长度信息
-        length_bytes = sock.recv(4)
-        if not length_bytes:
+        # 首先接收4字节的长度信息（recv(4) 可能只返回其中一部分，必须读满）
+        length_bytes = read_exact(source, 4)
+        if length_bytes is None:
             # 如果接收长度信息失败（例如，连接已关闭），则记录并返回 None
             logger.info("连接在接收长度前已关闭。")
             return None
 
         # 使用 struct.unpack 解包长度信息
-        length = struct.unpack('>I', length_bytes)[0]
+        length = _LENGTH_PREFIX.unpack(length_bytes)[0]
 
         # 对消息长度进行基本的健全性检查（例如，限制为合理大小）
         MAX_MSG_LENGTH = 1024 * 1024 # 设置1MB的上限，可根据需要调整
@@ -66,19 +148,15 @@ def receive_json(sock):
              return None
 
         # 根据获取到的长度接收完整的数据
-        data_bytes = b''
-        while len(data_bytes) < length:
-            # 循环接收，直到收到完整长度的数据
-            packet = sock.recv(length - len(data_bytes))
-            if not packet:
-                # 如果在接收数据过程中连接意外关闭
-                logger.warning("接收数据时连接意外关闭。")
-                return None
-            data_bytes += packet
+        data_bytes = read_exact(source, length)
+        if data_bytes is None:
+            # 如果在接收数据过程中连接意外关闭
+            logger.warning("接收数据时连接意外关闭。")
+            return None
 
         # 将接收到的字节解码为JSON对象
-        data = json.loads(data_bytes.decode('utf-8'))
-        logger.debug(f"成功接收并解析数据类型: {data.get('type')}") # 使用调试级别记录日志
+        data = orjson.loads(data_bytes) if USE_ORJSON else json.loads(data_bytes.decode('utf-8'))
+        logger.debug("成功接收并解析数据类型: %s", data.get('type')) # 使用调试级别记录日志
         return data
 
     # --- 异常处理 ---
@@ -97,7 +175,7 @@ def receive_json(sock):
         return None # 将其视为断开连接
     except Exception as e:
         # 记录其他未预料到的错误
-        logger.exception("接收数据时发生未知错误 (receive_json)")
+        logger.exception("接收数据时发生未知错误 (_receive_message)")
         # 这里不重新引发异常，返回 None 向调用者发出错误信号
         return None
 # --- 网络函数结束 ---
@@ -131,8 +209,14 @@ def tile_sort_key(tile):
 
 
 def sort_tiles(hand):
-    """对手牌列表（字符串列表）进行排序。"""
-    return sorted(hand, key=tile_sort_key)
+    """对手牌列表（字符串列表）进行排序。
+
+    牌编号的顺序与 tile_sort_key 一致，直接用 TILE_TO_ID 查编号作排序键；含无法识别的牌时退回 tile_sort_key。
+    """
+    try:
+        return sorted(hand, key=TILE_TO_ID.__getitem__)
+    except KeyError:
+        return sorted(hand, key=tile_sort_key)
 
 def is_triplet(tiles):
     """检查牌列表是否是刻子 (AAA)。"""
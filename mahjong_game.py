@@ -2,90 +2,281 @@
 # 定义麻将游戏的核心逻辑，包括牌堆、玩家、游戏流程等
 
 import random
-from collections import Counter
-import copy
 import logging
+from bisect import insort
+from operator import itemgetter
+from dataclasses import dataclass
+from typing import Any
 from mahjong_common import (
-    ALL_TILES_SUIT, ALL_TILES_WIND, ALL_TILES_DRAGON,
-    TILES_PER_TYPE, INITIAL_HAND_SIZE, sort_tiles, tile_sort_key,
+    TILES_PER_TYPE, INITIAL_HAND_SIZE,
     is_triplet, is_quad, is_pair,
+    TILE_TO_ID, ID_TO_TILE, NUM_TILE_KINDS, NUM_SUIT_KINDS,
+    ALL_TILE_IDS, SUIT_TILE_IDS,
 )
+import mahjong_solver
 
 logger = logging.getLogger(__name__)
 
+_meld_key = itemgetter(0)  # 亮牌按首张牌编号排序
+
+
+def _parse_tile(value):
+    """把消息中的牌名转换为牌编号，无法识别时返回 None。"""
+    return TILE_TO_ID.get(value) if isinstance(value, str) else None
+
+
+def _tile_str(tile_id):
+    """牌编号 -> 消息中使用的牌名（None 保持为 None）。"""
+    return ID_TO_TILE[tile_id] if tile_id is not None else None
+
+
+def _tile_strs(tile_ids):
+    """牌编号列表 -> 牌名列表，只在发送消息/生成状态时使用。"""
+    return [ID_TO_TILE[t] for t in tile_ids]
+
+
+def _melds_strs(melds):
+    return [[ID_TO_TILE[t] for t in meld] for meld in melds]
+
+
+def _gang_tile_str(gang_type, tile_info):
+    """杠的 tile_info -> 牌名，用于日志：补杠为 (亮牌序号, 牌编号)，只取牌；其余为牌编号。"""
+    try:
+        return _tile_str(tile_info[1] if gang_type == "bu" else tile_info)
+    except (TypeError, IndexError):
+        return repr(tile_info)  # 格式不对的 tile_info 原样输出，不能让日志本身出错
+
+
+def _build_win_neighbour_ids():
+    """对每种牌，列出能与其组成对子/刻子/顺子的牌编号（同花色距离 2 以内；字牌只有自身）。"""
+    table = []
+    for tile_id in range(NUM_TILE_KINDS):
+        if tile_id < NUM_SUIT_KINDS:
+            suit_start = tile_id - tile_id % 9
+            table.append(tuple(range(max(suit_start, tile_id - 2), min(suit_start + 8, tile_id + 2) + 1)))
+        else:
+            table.append((tile_id,))
+    return tuple(table)
+
+
+_WIN_NEIGHBOUR_IDS = _build_win_neighbour_ids()
+
+
+# action_responses 中每个座位的响应状态码
+_RESPONSE_IDLE = 0  # 尚未响应或本次弃牌与该座位无关 (是否在等待该座位见 Game._pending_mask)
+_RESPONSE_PASS = 1
+# 以下三种响应的编码值即优先级：越小越优先 (胡 > 杠 > 碰)
+_RESPONSE_HU = 2
+_RESPONSE_GANG = 3
+_RESPONSE_PONG = 4
+_RESPONSE_CODES = {"pass": _RESPONSE_PASS, "hu": _RESPONSE_HU, "gang": _RESPONSE_GANG, "pong": _RESPONSE_PONG}
+# Player.can_flags 的各位：对当前弃牌可以碰 / 明杠 / 胡
+CAN_PONG = 1
+CAN_GANG = 2
+CAN_HU = 4
+
+# 可响应动作 -> 附加 "pass" 后发给客户端的动作元组。组合只有少数几种，各次弃牌、各玩家共用同一个元组
+_response_prompt_actions = {}
+
+
+@dataclass(slots=True, frozen=True)
+class ActionMsg:
+    """玩家行动消息 (action) 的解析结果，一次性取出字段，避免处理时反复 .get()。牌名已转换为牌编号。"""
+    kind: str | None
+    tile: int | None
+    drawn_tile: int | None
+    gang_type: str | None
+    tile_info: Any
+
+    @classmethod
+    def from_dict(cls, action_data):
+        tile_info = action_data.get("tile_info")
+        if isinstance(tile_info, (list, tuple)):  # 补杠信息 (meld_index, tile) 经 JSON 传输后变为列表，统一为元组
+            tile_info = tuple(tile_info[:1]) + tuple(_parse_tile(t) for t in tile_info[1:])
+        else:
+            tile_info = _parse_tile(tile_info)
+        return cls(action_data.get("action_type"), _parse_tile(action_data.get("tile")),
+                   _parse_tile(action_data.get("drawn_tile")), action_data.get("gang_type"), tile_info)
+
+
+@dataclass(slots=True)
+class PendingAction:
+    """等待其他玩家响应的操作（目前只有对弃牌的响应）。"""
+    kind: str
+    discarded_tile: int
+    discarder_id: int
+    discarder_idx: int  # 放炮者的座位索引，询问响应时已知，结算时不必再查
+
+    def as_dict(self):
+        """转换为发送给客户端的字典格式（随 game_state 发送，牌与 state 其余部分一样用编号）。"""
+        return {"type": self.kind, "discarded_tile": self.discarded_tile,
+                "discarder_id": self.discarder_id}
 
 class Player:
     """表示一个玩家及其状态和操作。"""
 
+    __slots__ = (
+        "player_id", "player_id_str", "name", "hand_counts", "hand_size", "rules", "_accept", "_listen_cache",
+        "_melds", "melds_sig", "discarded",
+        "is_listening", "listening_tiles", "fixed_listening_tiles", "fixed_listening_tiles_set",
+        "is_attempting_ting", "current_drawn_tile_for_auto_discard",
+        "can_hu_zimo", "can_flags", "possible_an_gangs", "possible_bu_gangs",
+    )
+
     def __init__(self, player_id, name):
         self.player_id = player_id
+        self.player_id_str = str(player_id)  # 作为 JSON 对象键时使用
         self.name = name
-        self.hand = []
-        self.melds = []
+        # 手牌、亮牌、弃牌、听牌等内部都使用牌编号 (见 mahjong_common.TILE_TO_ID)
+        self.hand_counts = bytearray(NUM_TILE_KINDS)  # 手牌以计数向量保存：下标为牌编号，值为张数
+        self.hand_size = 0
+        self.rules = None  # 开局时由 Game 绑定的 GameRules
+        self._accept = None  # 当前 3n+1 张手牌的胡牌表缓存 (见 wins_with)，手牌或亮牌变动时置空
+        self._listen_cache = {}  # (手牌计数向量, 亮牌签名) -> 听牌集合，见 find_listening_tiles
+        self.melds = []  # 经 melds 属性设置，同时生成 melds_sig
         self.discarded = []
 
         self.is_listening = False
         self.listening_tiles = []
-        self.fixed_listening_tiles = []
+        self.fixed_listening_tiles = []  # 有序列表，用于发送消息
+        self.fixed_listening_tiles_set = frozenset()  # 同一组牌的集合，用于成员判断和比较
         self.is_attempting_ting = False
         self.current_drawn_tile_for_auto_discard = None
 
         self.can_hu_zimo = False
-        self.can_pong = False
-        self.can_gang = False  # 响应他人弃牌的明杠
-        self.can_hu_discard = False
+        self.can_flags = 0  # 对他人弃牌可作的响应 (CAN_PONG / CAN_GANG / CAN_HU 按位或)，明杠即 CAN_GANG
         self.possible_an_gangs = []
         self.possible_bu_gangs = []
 
+    @property
+    def hand(self):
+        """按牌编号排好序的手牌列表（每次新建），供生成消息和日志使用。"""
+        return self.hand_as_list()
+
+    @hand.setter
+    def hand(self, tiles):
+        counts = bytearray(NUM_TILE_KINDS)
+        for tile in tiles:
+            counts[tile] += 1
+        self.hand_counts = counts
+        self.hand_size = sum(counts)
+        self._accept = None
+        self._listen_cache.clear()
+
+    def hand_as_list(self):
+        counts = self.hand_counts
+        return [tile for tile in range(NUM_TILE_KINDS) for _ in range(counts[tile])]
+
     def add_tile(self, tile):
-        self.hand.append(tile)
-        self.hand = sort_tiles(self.hand)
+        self.hand_counts[tile] += 1
+        self.hand_size += 1
+        self._accept = None
 
     def remove_tile(self, tile):
-        try:
-            self.hand.remove(tile)
-            self.hand = sort_tiles(self.hand)
-            return True
-        except ValueError:
-            logger.warning(f"玩家 {self.name} ({self.player_id}) 尝试移除不存在的牌: {tile} 从手牌 {self.hand}")
-            return False
-
-    def can_pong_tile(self, tile_to_check, game_rules=None):  # game_rules 参数保留但未使用（除非未来添加其他规则）
-        if self.is_listening:
+        if not self._take_tiles(tile, 1):
+            logger.warning(f"玩家 {self.name} ({self.player_id}) 尝试移除不存在的牌: {ID_TO_TILE[tile]} 从手牌 {_tile_strs(self.hand)}")
             return False
-        return self.hand.count(tile_to_check) >= 2
+        return True
 
-    def perform_pong(self, tile_to_pong):
-        if self.hand.count(tile_to_pong) < 2:
+    def _take_tiles(self, tile, num):
+        """从手牌中一次取走 num 张 tile；张数不足时不做修改并返回 False。"""
+        if self.hand_counts[tile] < num:
             return False
-        self.remove_tile(tile_to_pong)
-        self.remove_tile(tile_to_pong)
-        self.melds.append(sort_tiles([tile_to_pong, tile_to_pong, tile_to_pong]))
-        self.melds = sorted(self.melds, key=lambda m: tile_sort_key(m[0]))
+        self.hand_counts[tile] -= num
+        self.hand_size -= num
+        self._accept = None
         return True
 
-    def find_possible_gangs(self, tile_from_discard=None, game_rules=None, drawn_tile_in_turn=None):
+    def simulation_copy(self):
+        """复制试算杠牌/听牌所需的状态（手牌、亮牌、规则），跳过 __init__ 中其余属性的初始化。"""
+        sim_player = object.__new__(Player)
+        sim_player.player_id = self.player_id
+        sim_player.player_id_str = self.player_id_str
+        sim_player.name = self.name
+        sim_player.rules = self.rules
+        sim_player.hand_counts = bytearray(self.hand_counts)
+        sim_player.hand_size = self.hand_size
+        sim_player._melds = [list(meld) for meld in self._melds]
+        sim_player.melds_sig = self.melds_sig
+        sim_player.is_listening = False
+        sim_player.listening_tiles = []
+        sim_player._accept = None
+        sim_player._listen_cache = {}
+        return sim_player
+
+    @property
+    def melds(self):
+        return self._melds
+
+    @melds.setter
+    def melds(self, melds):
+        self._melds = melds
+        self._update_melds_sig()
+
+    def _update_melds_sig(self):
+        """亮牌变动后重新生成 melds_sig：每组亮牌记为 (牌编号, 张数) 两个字节，按亮牌顺序排列，用作缓存键的一部分。"""
+        self.melds_sig = bytes([b for meld in self._melds for b in (meld[0], len(meld))])
+
+    def may_win_with(self, tile_id):
+        """胡牌的快速必要条件：该牌必须能与手牌或亮牌中的某张牌组成对子、刻子或顺子。"""
+        neighbour_ids = _WIN_NEIGHBOUR_IDS[tile_id]
+        counts = self.hand_counts
+        if any(counts[i] for i in neighbour_ids):
+            return True
+        return any(meld[0] in neighbour_ids for meld in self.melds)
+
+    def wins_with(self, tile_id):
+        """当前手牌再得到牌 tile_id 能否胡牌。
+
+        3n+1 张手牌时结果按牌编号记入胡牌表 (_accept: 0=未计算, 1=不能胡, 2=能胡)，
+        手牌不变期间（如其他玩家连续打出同一张牌、听牌计算）直接复用。
+        """
+        if self.hand_size % 3 != 1:
+            return self.can_hu_tile(tile_to_win=tile_id)
+        if self._accept is None:
+            self._accept = bytearray(NUM_TILE_KINDS)
+        known = self._accept[tile_id]
+        if known:
+            return known == 2
+        wins = self.may_win_with(tile_id) and self.can_hu_tile(tile_to_win=tile_id)
+        self._accept[tile_id] = 2 if wins else 1
+        return wins
+
+    def claim_discard_unchecked(self, tile, meld_size):
+        """碰 (meld_size=3) 或明杠 (meld_size=4) 他人打出的 tile。
+
+        调用者须已确认手牌中有 meld_size - 1 张 tile (见 Game.check_other_players_actions 设置的 can_flags)，
+        这里不再校验，也不像 perform_gang 那样保存快照以便回滚。
+        """
+        taken = meld_size - 1
+        self.hand_counts[tile] -= taken
+        self.hand_size -= taken
+        insort(self._melds, [tile] * meld_size, key=_meld_key)
+        self._update_melds_sig()
+        self._accept = None
+
+    def find_possible_gangs(self, tile_from_discard=None, drawn_tile_in_turn=None):
         possible_an_gangs_val = []
         possible_bu_gangs_val = []
         possible_ming_gangs_val = []
 
-        hand_counts = Counter(self.hand)
+        hand_counts = self.hand_counts
 
         # 1. 查找暗杠 (An Gang) - 手牌中有4张相同的牌
-        for tile_val, count in hand_counts.items():
-            if count == 4:
+        for tile_val in range(NUM_TILE_KINDS):
+            if hand_counts[tile_val] == 4:
                 possible_an_gangs_val.append(tile_val)
 
         # 2. 查找补杠 (Bu Gang / Additive Kong) - 手牌中有一张与已碰出的刻子相同的牌
         for i, meld in enumerate(self.melds):
             if is_triplet(meld):
                 tile_in_meld = meld[0]
-                if hand_counts.get(tile_in_meld, 0) >= 1:
+                if hand_counts[tile_in_meld] >= 1:
                     possible_bu_gangs_val.append((i, tile_in_meld))
 
         # 3. 查找明杠 (Ming Gang) - 仅当 tile_from_discard 非空时，手牌中有3张与弃牌相同的牌
-        if tile_from_discard and not self.is_listening:
-            if hand_counts.get(tile_from_discard, 0) == 3:
+        if tile_from_discard is not None and not self.is_listening:
+            if hand_counts[tile_from_discard] == 3:
                 possible_ming_gangs_val.append(tile_from_discard)
 
         self.possible_an_gangs = list(set(possible_an_gangs_val))
@@ -93,19 +284,19 @@ class Player:
 
         return self.possible_an_gangs, self.possible_bu_gangs, list(set(possible_ming_gangs_val))
 
-    def perform_gang(self, gang_type, tile_info, tile_discarded_for_ming_gang=None, game_rules=None):
-        original_hand = copy.deepcopy(self.hand)
-        original_melds = copy.deepcopy(self.melds)
+    def perform_gang(self, gang_type, tile_info):
+        """本人回合的暗杠 (tile_info 为牌编号) 或补杠 (tile_info 为 (亮牌序号, 牌编号))。明杠见 claim_discard_unchecked。"""
+        original_hand_counts = bytes(self.hand_counts)
+        original_melds = [list(meld) for meld in self.melds]  # 牌编号不可变，复制两层列表即可
 
         try:
             if gang_type == "an":
                 target_tile = tile_info
-                if self.hand.count(target_tile) < 4:  # 暗杠必须手牌4张
-                    logger.error(f"暗杠时手牌不足4张: {target_tile} (玩家 {self.name})")
+                if not self._take_tiles(target_tile, 4):  # 暗杠必须手牌4张
+                    logger.error(f"暗杠时手牌不足4张: {ID_TO_TILE[target_tile]} (玩家 {self.name})")
                     return False
-                for _ in range(4): self.remove_tile(target_tile)
-                self.melds.append(sort_tiles([target_tile] * 4))
-                logger.debug(f"{self.name} 执行暗杠: {target_tile}")
+                insort(self._melds, [target_tile] * 4, key=_meld_key)
+                logger.debug("%s 执行暗杠: %s", self.name, ID_TO_TILE[target_tile])
 
             elif gang_type == "bu":
                 meld_index, tile_to_complete_meld = tile_info
@@ -113,180 +304,184 @@ class Player:
                         is_triplet(self.melds[meld_index]) and
                         self.melds[meld_index][0] == tile_to_complete_meld):
                     return False
-                if self.hand.count(tile_to_complete_meld) < 1:
+                if not self._take_tiles(tile_to_complete_meld, 1):
                     return False
-                self.remove_tile(tile_to_complete_meld)
                 self.melds[meld_index].append(tile_to_complete_meld)
-                self.melds[meld_index] = sort_tiles(self.melds[meld_index])
-                logger.debug(f"{self.name} 执行补杠: {tile_to_complete_meld}")
+                logger.debug("%s 执行补杠: %s", self.name, ID_TO_TILE[tile_to_complete_meld])
 
-            elif gang_type == "ming":
-                target_tile = tile_info
-                if self.hand.count(target_tile) < 3:  # 明杠需要手牌3张
-                    return False
-                for _ in range(3): self.remove_tile(target_tile)
-                self.melds.append(sort_tiles([target_tile] * 4))
-                logger.debug(f"{self.name} 执行明杠: {target_tile} (杠的是 {tile_discarded_for_ming_gang})")
             else:
                 return False
 
-            self.melds = sorted(self.melds, key=lambda m: tile_sort_key(m[0]))
+            self._update_melds_sig()
+            self._accept = None
             return True
         except Exception as e:
-            logger.exception(f"执行杠操作时发生错误 (玩家 {self.name}, 类型 {gang_type}, 信息 {tile_info})")
-            self.hand = original_hand
+            logger.exception("执行杠操作时发生错误 (玩家 %s, 类型 %s, 牌 %s)",
+                             self.name, gang_type, _gang_tile_str(gang_type, tile_info))
+            self.hand_counts = bytearray(original_hand_counts)
+            self.hand_size = sum(self.hand_counts)
             self.melds = original_melds
+            self._accept = None
             return False
 
-    def get_tile_type_and_value(self, tile_str):  # 保持不变
-        if tile_str is None: return None, None
-        parts = tile_str.split('_')
-        suit = parts[0]
-        value_str = parts[1]
-        if suit in ["wan", "tiao", "tong"]:
-            try:
-                return suit, int(value_str)
-            except ValueError:
-                return suit, value_str
-        return suit, value_str
-
-    def _can_form_melds_recursive(self, current_tiles_list, game_rules):  # 移除 num_jokers
-        if not current_tiles_list:
-            return True
-
-        sorted_current_tiles = sort_tiles(current_tiles_list)
-        counts = Counter(sorted_current_tiles)
-        first_tile = sorted_current_tiles[0]
-
-        # 1. 尝试移除刻子 (AAA)
-        if counts.get(first_tile, 0) >= 3:
-            remaining_after_triplet = list(sorted_current_tiles)
-            for _ in range(3): remaining_after_triplet.remove(first_tile)
-            if self._can_form_melds_recursive(remaining_after_triplet, game_rules):
-                return True
-
-        # 2. 尝试移除顺子 (ABC)
-        tile_type, tile_value = self.get_tile_type_and_value(first_tile)
-        if tile_type in ["wan", "tiao", "tong"] and isinstance(tile_value, int) and tile_value <= 7:
-            t1_str, t2_str, t3_str = first_tile, f"{tile_type}_{tile_value + 1}", f"{tile_type}_{tile_value + 2}"
-            if counts.get(t1_str, 0) >= 1 and counts.get(t2_str, 0) >= 1 and counts.get(t3_str, 0) >= 1:
-                temp_list = list(sorted_current_tiles)
-                temp_list.remove(t1_str);
-                temp_list.remove(t2_str);
-                temp_list.remove(t3_str)
-                if self._can_form_melds_recursive(temp_list, game_rules):
-                    return True
-        return False
-
-    def check_standard_win(self, tiles_for_check, game_rules):  # 移除 joker 相关
-        if len(tiles_for_check) % 3 != 2 or len(tiles_for_check) < 2:
-            return False
-
-        non_joker_tiles = list(tiles_for_check)  # 现在所有牌都是非混儿牌
-        unique_tiles_for_pair = sort_tiles(list(set(non_joker_tiles)))
-
-        for pair_tile in unique_tiles_for_pair:
-            if non_joker_tiles.count(pair_tile) >= 2:
-                remaining_tiles = list(non_joker_tiles)
-                remaining_tiles.remove(pair_tile);
-                remaining_tiles.remove(pair_tile)
-                if self._can_form_melds_recursive(remaining_tiles, game_rules):
-                    return True
-        return False
-
-    def can_hu_tile(self, tile_to_win=None, is_zimo=False, game_rules=None, hand_override=None):
-        current_hand = hand_override if hand_override is not None else self.hand
-        all_tiles_for_check = []
-        all_tiles_for_check.extend(current_hand)
-        for meld_group in self.melds:
-            all_tiles_for_check.extend(meld_group)
-
-        if is_zimo:
-            if tile_to_win and tile_to_win not in current_hand:
-                pass
-        elif tile_to_win:
-            all_tiles_for_check.append(tile_to_win)
-
-        all_tiles_for_check = sort_tiles(all_tiles_for_check)
-
+    def check_standard_win(self, counts):  # 移除 joker 相关
+        """counts 为全部牌（手牌+亮牌）的计数向量 (bytearray)。"""
+        return mahjong_solver.check_standard_win(counts)
+
+    def _counts_including_melds(self, hand_tiles=None):
+        """返回 (计数向量, 总张数)：自身手牌（或给定的 hand_tiles：牌列表或计数向量）加上全部亮牌。"""
+        if isinstance(hand_tiles, (bytes, bytearray)):
+            counts = bytearray(hand_tiles)
+            total_tiles = sum(counts)
+        elif hand_tiles is not None:
+            counts = bytearray(NUM_TILE_KINDS)
+            for tile in hand_tiles:
+                counts[tile] += 1
+            total_tiles = len(hand_tiles)
+        else:
+            counts = bytearray(self.hand_counts)
+            total_tiles = self.hand_size
+        for meld_group in self.melds:  # 亮牌只有刻子和杠，都由同一种牌组成
+            counts[meld_group[0]] += len(meld_group)
+            total_tiles += len(meld_group)
+        return counts, total_tiles
+
+    def _can_hu_counts(self, counts, total_tiles):
+        """counts 为包含亮牌在内的全部牌的计数向量，判断是否成胡（标准胡牌或七对）。"""
         # 1. 检查标准胡牌 (m * 面子 + 1 * 将)
-        if len(all_tiles_for_check) % 3 == 2 and self.check_standard_win(all_tiles_for_check, game_rules):
-            logger.debug(f"标准胡牌结构检查通过 (check_standard_win): {all_tiles_for_check}")
+        if total_tiles % 3 == 2 and self.check_standard_win(counts):
+            logger.debug("玩家 %s 标准胡牌结构检查通过 (check_standard_win)", self.name)
             return True
 
         # 2. 检查七对 (14张牌, 没有亮牌, 7个对子)
-        if len(all_tiles_for_check) == 14 and not self.melds:
-            counts_qidu = Counter(all_tiles_for_check)
-            pairs_found = 0
-            for count in counts_qidu.values():
-                if count == 2:
-                    pairs_found += 1
-                elif count == 4:
-                    pairs_found += 2  # 四张算两对 (豪华七对基础)
-
-            if pairs_found == 7:
-                logger.debug(f"七对检查通过: {all_tiles_for_check}")
-                return True
+        # 共 14 张时，每种牌都是偶数张即为 7 对（四张算两对，豪华七对基础），有一张奇数即可排除
+        if total_tiles == 14 and not self.melds and not any(count & 1 for count in counts):
+            logger.debug("玩家 %s 七对检查通过", self.name)
+            return True
         return False
 
-    def find_listening_tiles(self, game_rules, possible_draw_tiles_list=None, hand_to_check=None):
-        current_hand = hand_to_check if hand_to_check is not None else self.hand
-
-        if len(current_hand) % 3 != 1:
-            return []
+    def can_hu_tile(self, tile_to_win=None, is_zimo=False, hand_override=None):
+        # 直接在计数向量上累加，不生成、也不排序牌列表
+        counts, total_tiles = self._counts_including_melds(hand_override)
+        if not is_zimo and tile_to_win is not None:  # 自摸时摸到的牌已在手牌中
+            counts[tile_to_win] += 1
+            total_tiles += 1
+        return self._can_hu_counts(counts, total_tiles)
+
+    def find_listening_tiles(self, possible_draw_tiles_list=None, hand_to_check=None):
+        """返回听牌的 frozenset；检查自身手牌时同时把有序的听牌列表写入 listening_tiles。
+
+        possible_draw_tiles_list 为候选牌编号，默认为全部牌 (ALL_TILE_IDS)；hand_to_check 可以是牌列表或计数向量。
+        """
+        if hand_to_check is None:
+            hand_size = self.hand_size
+        elif isinstance(hand_to_check, (bytes, bytearray)):
+            hand_size = sum(hand_to_check)
+        else:
+            hand_size = len(hand_to_check)
+        if hand_size % 3 != 1:
+            return frozenset()
 
         if possible_draw_tiles_list is None:
-            all_game_tiles_unique = list(set(ALL_TILES_SUIT + ALL_TILES_WIND + ALL_TILES_DRAGON))
+            all_game_tiles_unique = ALL_TILE_IDS
+        elif isinstance(possible_draw_tiles_list, tuple):  # 预先生成的候选元组（如 Game.all_game_tiles_list）不需要去重
+            all_game_tiles_unique = possible_draw_tiles_list
         else:
-            all_game_tiles_unique = list(set(possible_draw_tiles_list))
-
+            all_game_tiles_unique = tuple(set(possible_draw_tiles_list))
+
+        # 键中包含手牌和亮牌，摸打之后回到同样的牌型（如听牌后摸切）时直接复用
+        cache_key = None
+        if hand_to_check is None:
+            cache_key = (bytes(self.hand_counts), self.melds_sig, all_game_tiles_unique)
+            cached = self._listen_cache.get(cache_key)
+            if cached is not None:
+                self.listening_tiles = sorted(cached)
+                return cached
+
+        # 手牌+亮牌的计数向量只构建一次，每个候选牌加一张、检查后再减回
+        counts, total_tiles = self._counts_including_melds(hand_to_check)
+        total_tiles += 1
         listening = set()
-        for test_tile in all_game_tiles_unique:
-            if self.can_hu_tile(tile_to_win=test_tile, is_zimo=False, game_rules=game_rules,
-                                hand_override=current_hand):
-                listening.add(test_tile)
-
-        result_listening_tiles = sort_tiles(list(listening))
+        if hand_to_check is None:  # 检查自身手牌时先查胡牌表，并把结果记入胡牌表 (见 wins_with)
+            if self._accept is None:
+                self._accept = bytearray(NUM_TILE_KINDS)
+            accept = self._accept
+            for test_tile in all_game_tiles_unique:
+                known = accept[test_tile]
+                if not known:
+                    wins = False
+                    if self.may_win_with(test_tile):
+                        counts[test_tile] += 1
+                        wins = self._can_hu_counts(counts, total_tiles)
+                        counts[test_tile] -= 1
+                    known = accept[test_tile] = 2 if wins else 1
+                if known == 2:
+                    listening.add(test_tile)
+        else:
+            for test_tile in all_game_tiles_unique:
+                counts[test_tile] += 1
+                if self._can_hu_counts(counts, total_tiles):
+                    listening.add(test_tile)
+                counts[test_tile] -= 1
+
+        result_listening_tiles = frozenset(listening)
+        if cache_key is not None:
+            self._listen_cache[cache_key] = result_listening_tiles
         if hand_to_check is None:  # 更新自身听牌列表当检查自身手牌时
-            self.listening_tiles = result_listening_tiles
-            logger.debug(
-                f"玩家 {self.name} 计算听牌结果 (手牌 {self.hand}, 亮牌 {self.melds}): {self.listening_tiles}")
+            self.listening_tiles = sorted(result_listening_tiles)
+            if logger.isEnabledFor(logging.DEBUG):  # self.hand 每次都会新建列表，只在需要时生成
+                logger.debug("玩家 %s 计算听牌结果 (手牌 %s, 亮牌 %s): %s",
+                             self.name, _tile_strs(self.hand), _melds_strs(self.melds), _tile_strs(self.listening_tiles))
         return result_listening_tiles
 
 
+@dataclass(slots=True, frozen=True)
 class GameRules:
-    """存储游戏特定规则的配置类。"""
+    """存储游戏特定规则的配置类（创建后不可变，开局时绑定到各玩家）。"""
+    include_winds_dragons: bool = True
+
+    def __post_init__(self):
+        logger.info(f"游戏规则初始化: 含风箭={self.include_winds_dragons}")
 
-    def __init__(self, include_winds_dragons=True):  # 简化
-        self.include_winds_dragons = include_winds_dragons
-        logger.info(f"游戏规则初始化: 含风箭={include_winds_dragons}")
+
+def _build_deck_template(include_winds_dragons):
+    """生成未洗牌的整副牌（牌编号，每种 TILES_PER_TYPE 张），不含风箭时只有万/条/筒。"""
+    num_kinds = NUM_TILE_KINDS if include_winds_dragons else NUM_SUIT_KINDS
+    return tuple(tile_id for tile_id in range(num_kinds) for _ in range(TILES_PER_TYPE))
+
+
+_DECK_TEMPLATES = {flag: _build_deck_template(flag) for flag in (False, True)}
 
 
 class Deck:
     """表示牌堆及其操作。"""
 
     def __init__(self, game_rules):
-        self.tiles = []
         self.game_rules = game_rules  # GameRules 仍然有用，比如是否包含风牌箭牌
-        for tile_str in ALL_TILES_SUIT: self.tiles.extend([tile_str] * TILES_PER_TYPE)
-        if self.game_rules.include_winds_dragons:
-            for tile_str in ALL_TILES_WIND: self.tiles.extend([tile_str] * TILES_PER_TYPE)
-            for tile_str in ALL_TILES_DRAGON: self.tiles.extend([tile_str] * TILES_PER_TYPE)
-
+        # 牌堆中存放牌编号，只在发消息时转换为牌名；从预先生成的整副牌复制后洗牌
+        self.tiles = list(_DECK_TEMPLATES[bool(self.game_rules.include_winds_dragons)])
         random.shuffle(self.tiles)
         self.initial_size = len(self.tiles)
-        logger.debug(f"牌堆初始化完成，总共 {self.initial_size} 张牌。")
+        # 摸牌不从列表中删除，只移动首尾下标：tiles[_head:_tail] 为剩余的牌
+        self._head = 0
+        self._tail = self.initial_size
+        logger.debug("牌堆初始化完成，总共 %d 张牌。", self.initial_size)
 
     def draw_tile(self):
-        if self.tiles: return self.tiles.pop(0)
+        if self._head < self._tail:
+            tile = self.tiles[self._head]
+            self._head += 1
+            return tile
         return None
 
     def draw_from_end(self):
-        if self.tiles: return self.tiles.pop()
+        if self._head < self._tail:
+            self._tail -= 1
+            return self.tiles[self._tail]
         return None
 
     def remaining(self):
-        return len(self.tiles)
+        return self._tail - self._head
 
 
 class Game:  # Game 类中的大部分逻辑保持，但其调用的 Player 方法已简化
@@ -304,6 +499,9 @@ class Game:  # Game 类中的大部分逻辑保持，但其调用的 Player 方
 
         self.deck = None
         self.players = []
+        # player_id -> 座位索引 / Player 对象，玩家加入或离开时更新，避免每次按 ID 线性查找
+        self._pid_to_index = {}
+        self._pid_to_player = {}
         self.current_turn = 0
         self.discard_pile = []
         self.last_discarded_tile = None
@@ -312,16 +510,25 @@ class Game:  # Game 类中的大部分逻辑保持，但其调用的 Player 方
         self.winning_player_id = None
         self.winning_tile = None
         self.action_pending = False
-        self.action_responses = {}
+        # 以下两个按座位索引的列表整局复用，每次弃牌处理完后用切片赋值整体恢复为空闲状态
+        self._idle_responses = (_RESPONSE_IDLE,) * num_players
+        self._no_allowed_responses = (frozenset(),) * num_players
+        self.action_responses = list(self._idle_responses)  # 按座位索引的响应状态码
+        self._pending_mask = 0  # 第 i 位为 1 表示仍在等待座位 i 对弃牌的响应
+        self._allowed_responses = list(self._no_allowed_responses)  # 按座位索引：本次弃牌该座位可作的响应 (含 "pass")
         self._pending_action_info = None
         self._next_prompt_info = None
+        self._last_action_prompt = None  # 最近一次发给当前行动玩家的 (player_id, 提示)，行动无效时原样重发
+        # 行动类型 -> 处理方法 的分派表
+        self._action_handlers = {
+            "ting": self._handle_ting_action,
+            "discard": self._handle_discard_action,
+            "hu": self._handle_hu_action,
+            "gang": self._handle_gang_action,
+        }
 
-        # 生成所有游戏中会用到的牌的列表（用于听牌检查等）
-        temp_all_tiles = list(ALL_TILES_SUIT)
-        if self.game_rules.include_winds_dragons:
-            temp_all_tiles.extend(ALL_TILES_WIND)
-            temp_all_tiles.extend(ALL_TILES_DRAGON)
-        self.all_game_tiles_list = list(set(temp_all_tiles))
+        # 所有游戏中会用到的牌的编号（用于听牌检查等），按规则取预先生成的元组
+        self.all_game_tiles_list = ALL_TILE_IDS if self.game_rules.include_winds_dragons else SUIT_TILE_IDS
 
         logger.info(f"游戏实例初始化: {num_players}人。规则见 GameRules 日志。")
 
@@ -330,9 +537,22 @@ class Game:  # Game 类中的大部分逻辑保持，但其调用的 Player 方
             return False
         if len(self.players) < self.num_players:
             self.players.append(player_obj)
+            self._index_players()
             return True
         return False
 
+    def remove_waiting_player(self, player_obj):
+        """开局前有玩家离开时将其移出玩家列表。"""
+        if self.game_state != "waiting" or player_obj not in self.players:
+            return False
+        self.players.remove(player_obj)
+        self._index_players()
+        return True
+
+    def _index_players(self):
+        self._pid_to_index = {p.player_id: i for i, p in enumerate(self.players)}
+        self._pid_to_player = {p.player_id: p for p in self.players}
+
     def start_game(self):
         if len(self.players) != self.num_players:
             logger.error(f"玩家数量不足 ({len(self.players)}/{self.num_players})，无法开始游戏。")
@@ -343,19 +563,21 @@ class Game:  # Game 类中的大部分逻辑保持，但其调用的 Player 方
         self.deck = Deck(self.game_rules)
 
         for p in self.players:
+            p.rules = self.game_rules
             p.hand = []
             p.melds = []
             p.discarded = []
             p.is_listening = False
             p.listening_tiles = []
             p.fixed_listening_tiles = []
+            p.fixed_listening_tiles_set = frozenset()
             p.is_attempting_ting = False
             p.current_drawn_tile_for_auto_discard = None
 
         for _ in range(INITIAL_HAND_SIZE):  # 发13张牌
             for player in self.players:
                 tile = self.deck.draw_tile()
-                if tile:
+                if tile is not None:
                     player.add_tile(tile)
                 else:
                     self.end_game("发牌时牌不够"); return False
@@ -371,34 +593,52 @@ class Game:  # Game 类中的大部分逻辑保持，但其调用的 Player 方
             return False
         return True
 
-    def get_player_by_id(self, player_id):  # 保持不变
-        for player in self.players:
-            if player.player_id == player_id: return player
-        return None
-
-    def get_player_index_by_id(self, player_id):  # 保持不变
-        for i, player in enumerate(self.players):
-            if player.player_id == player_id: return i
-        return -1
+    def get_player_by_id(self, player_id):
+        return self._pid_to_player.get(player_id)
 
     def get_state_for_player(self, player_id_to_get_state_for):  # 移除 joker_tile
-        player_obj = self.get_player_by_id(player_id_to_get_state_for)
-        if not player_obj: return None
+        player_index = self._pid_to_index.get(player_id_to_get_state_for, -1)
+        if player_index == -1: return None
+        return self._build_player_state(player_index, self._public_player_states())
+
+    def get_states_for_all_players(self):
+        """返回 {player_id: state}，与逐个调用 get_state_for_player 的结果相同。
+
+        各玩家的公开信息只生成一次，所有 state 共用这些对象，因此编码发送之前不要修改它们。
+        state 中的手牌、亮牌、弃牌、听牌、最后打出的牌和待响应的弃牌都是牌编号 (0-33)，由客户端换回牌名，
+        比牌名字符串小得多；game_state 是发送最频繁的消息。
+        """
+        public_states = self._public_player_states()
+        return {p.player_id: self._build_player_state(i, public_states) for i, p in enumerate(self.players)}
+
+    def _current_turn_player_id(self):
+        return self.players[self.current_turn].player_id if self.game_state == "playing" and self.players else None
+
+    def _public_player_states(self):
+        """所有玩家对他人可见的信息。听牌张只对本人可见，这里一律留空，由 _build_player_state 为本人补上。"""
+        current_turn_player_id = self._current_turn_player_id()
+        return [
+            {
+                "player_id": p.player_id, "name": p.name,
+                "is_current_turn": p.player_id == current_turn_player_id,
+                "hand_size": p.hand_size, "melds": [list(meld) for meld in p.melds], "discarded": list(p.discarded),
+                "is_listening": p.is_listening,
+                "listening_tiles": [],
+            } for p in self.players
+        ]
+
+    def _build_player_state(self, player_index, public_states):
+        player_obj = self.players[player_index]
+        players_info = public_states
+        if player_obj.is_listening:  # 只在本人的 state 中替换自己那一项，其余项共用
+            players_info = list(public_states)
+            players_info[player_index] = dict(public_states[player_index],
+                                              listening_tiles=list(player_obj.listening_tiles))
 
         state = {
             "game_state": self.game_state,
-            "current_turn_player_id": self.players[
-                self.current_turn].player_id if self.game_state == "playing" and self.players else None,
-            "players": [
-                {
-                    "player_id": p.player_id, "name": p.name,
-                    "is_current_turn": (self.game_state == "playing" and p.player_id == self.players[
-                        self.current_turn].player_id),
-                    "hand_size": len(p.hand), "melds": p.melds, "discarded": p.discarded,
-                    "is_listening": p.is_listening,
-                    "listening_tiles": p.listening_tiles if p.player_id == player_id_to_get_state_for and p.is_listening else [],
-                } for p in self.players
-            ],
+            "current_turn_player_id": self._current_turn_player_id(),
+            "players": players_info,
             "your_hand": player_obj.hand,
             "last_discarded_tile": self.last_discarded_tile,
             "last_discarder_id": self.last_discarder_id,
@@ -406,11 +646,24 @@ class Game:  # Game 类中的大部分逻辑保持，但其调用的 Player 方
             "winning_player_id": self.winning_player_id,
             "winning_tile": self.winning_tile,
             "action_pending": self.action_pending,
-            "pending_action_info": self._pending_action_info if self.action_pending else None,
+            "pending_action_info": self._pending_action_info.as_dict() if self.action_pending else None,
             "is_attempting_ting": player_obj.is_attempting_ting
         }
         return state
 
+    def remaining_supply(self, player):
+        """对 player 而言每种牌还可能摸到或被打出的张数：4 张减去牌池、所有亮牌及其自己手牌中的张数。"""
+        supply = bytearray([TILES_PER_TYPE]) * NUM_TILE_KINDS
+        for tile in self.discard_pile:
+            supply[tile] -= 1
+        for p in self.players:
+            for meld in p.melds:
+                supply[meld[0]] -= len(meld)
+        hand_counts = player.hand_counts
+        for tile in range(NUM_TILE_KINDS):
+            supply[tile] -= hand_counts[tile]
+        return supply
+
     def _start_player_turn_logic(self, player_index, drawn_tile_override=None, is_gang_replacement_draw=False):
         if self.game_state != "playing": return False
         if not (0 <= player_index < len(self.players)): return False
@@ -424,25 +677,29 @@ class Game:  # Game 类中的大部分逻辑保持，但其调用的 Player 方
         logger.info(f"--- 轮到 {player.name} ({player.player_id}) 回合 ---")
 
         drawn_tile_this_turn = None
-        if drawn_tile_override:
+        if drawn_tile_override is not None:
             drawn_tile_this_turn = drawn_tile_override
+            # 摸到的牌已在手牌中，完整检查自摸
+            player.can_hu_zimo = player.can_hu_tile(tile_to_win=drawn_tile_this_turn, is_zimo=True)
         else:  # 正常摸牌
             drawn_tile_this_turn = self.deck.draw_tile()
-            if not drawn_tile_this_turn:
+            if drawn_tile_this_turn is None:
                 self.end_game("牌摸完了 (流局)")
                 return False
+            # 用摸牌前手牌的胡牌表判断自摸
+            player.can_hu_zimo = player.wins_with(drawn_tile_this_turn)
             player.add_tile(drawn_tile_this_turn)
 
-        logger.debug(
-            f"{player.name} {'摸到' if not drawn_tile_override else ('杠后补到' if is_gang_replacement_draw else '处理')}一张牌: {drawn_tile_this_turn} (手牌: {player.hand})")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("%s %s一张牌: %s (手牌: %s)", player.name,
+                         '摸到' if drawn_tile_override is None else ('杠后补到' if is_gang_replacement_draw else '处理'),
+                         ID_TO_TILE[drawn_tile_this_turn], _tile_strs(player.hand))
         player.current_drawn_tile_for_auto_discard = drawn_tile_this_turn
 
         actions = []
         # drawn_tile_in_turn 对 find_possible_gangs 不再那么重要，因为它现在只看手牌
-        possible_an, possible_bu, _ = player.find_possible_gangs(game_rules=self.game_rules)
+        possible_an, possible_bu, _ = player.find_possible_gangs()
 
-        player.can_hu_zimo = player.can_hu_tile(tile_to_win=drawn_tile_this_turn, is_zimo=True,
-                                                game_rules=self.game_rules)
         if player.can_hu_zimo:
             actions.append("hu")
 
@@ -480,176 +737,195 @@ class Game:  # Game 类中的大部分逻辑保持，但其调用的 Player 方
 
         message = {
             "type": "action_prompt", "actions": list(set(actions)),
-            "drawn_tile": drawn_tile_this_turn,
-            "possible_an_gangs": player.possible_an_gangs,
-            "possible_bu_gangs": player.possible_bu_gangs,
+            "drawn_tile": ID_TO_TILE[drawn_tile_this_turn],
+            "possible_an_gangs": _tile_strs(player.possible_an_gangs),
+            "possible_bu_gangs": [(meld_index, ID_TO_TILE[t]) for meld_index, t in player.possible_bu_gangs],
             "is_gang_replacement": is_gang_replacement_draw,
             "is_listening_player_turn": player.is_listening
         }
-        self._next_prompt_info = (player.player_id, message)
-        logger.debug(
-            f"为玩家 {player.player_id} 设置行动提示: {actions}, 摸牌: {drawn_tile_this_turn}, 是否听牌回合: {player.is_listening}")
+        self._set_action_prompt(player.player_id, message)
+        logger.debug("为玩家 %s 设置行动提示: %s, 摸牌: %s, 是否听牌回合: %s",
+                     player.player_id, actions, message["drawn_tile"], player.is_listening)
         return True
 
+    def _set_action_prompt(self, player_id, message):
+        """设置待发送给当前行动玩家的提示，并记下以便其行动无效时重发。"""
+        self._next_prompt_info = (player_id, message)
+        self._last_action_prompt = self._next_prompt_info
+
+    def _reprompt_player(self, player):
+        """玩家行动无效（状态未改变）时重发上一次的提示，不重新计算胡/杠选项。"""
+        if self._last_action_prompt is not None and self._last_action_prompt[0] == player.player_id:
+            self._next_prompt_info = self._last_action_prompt
+        else:
+            self._start_player_turn_logic(self.current_turn,
+                                          drawn_tile_override=player.current_drawn_tile_for_auto_discard)
+
     def _check_gang_maintains_listen(self, player, gang_type, gang_info, drawn_tile_for_current_turn):
         if not player.is_listening or not player.fixed_listening_tiles:
             return False
 
-        sim_player = Player(player.player_id, player.name)
-        sim_player.hand = copy.deepcopy(player.hand)
-        sim_player.melds = copy.deepcopy(player.melds)
+        sim_player = player.simulation_copy()
         # sim_player.is_listening = True # 不再需要，find_listening_tiles 不依赖它
         # sim_player.fixed_listening_tiles = list(player.fixed_listening_tiles)
 
-        if not sim_player.perform_gang(gang_type, gang_info, game_rules=self.game_rules):
+        if not sim_player.perform_gang(gang_type, gang_info):
             return False
 
-            # 杠完后，手牌是10张 (或更少)，用这个手牌去计算新的听牌
-        new_waits = sim_player.find_listening_tiles(game_rules=self.game_rules, hand_to_check=sim_player.hand)
+        # 杠完后，手牌是10张 (或更少)，用这个手牌去计算新的听牌；与叫听时一样只比较还可能出现的牌
+        supply = self.remaining_supply(player)
+        candidates = tuple(tile for tile in self.all_game_tiles_list if supply[tile])
+        new_waits = sim_player.find_listening_tiles(candidates)
 
-        logger.debug(
-            f"检查杠牌是否改变听牌: 原固定听牌 {player.fixed_listening_tiles}, 杠后 ({gang_type} {gang_info}) 新听牌 {new_waits}")
-        return set(new_waits) == set(player.fixed_listening_tiles)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("检查杠牌是否改变听牌: 原固定听牌 %s, 杠后 (%s %s) 新听牌 %s",
+                         _tile_strs(player.fixed_listening_tiles), gang_type, _gang_tile_str(gang_type, gang_info),
+                         _tile_strs(sorted(new_waits)))
+        return new_waits == player.fixed_listening_tiles_set.intersection(candidates)
 
     def handle_player_action(self, player_id, action_data):  # 移除过水相关
-        player_index = self.get_player_index_by_id(player_id)
+        player_index = self._pid_to_index.get(player_id, -1)
         if player_index == -1 or player_index != self.current_turn:
             self.send_message_to_player(player_id, {"type": "error", "message": "不是你的回合"})
             return
 
         player = self.players[player_index]
-        action_type = action_data.get("action_type")
-        logger.info(f"玩家 {player.name} ({player_id}) 请求执行操作: {action_type} (数据: {action_data})")
+        action = ActionMsg.from_dict(action_data)
+        logger.info(f"玩家 {player.name} ({player_id}) 请求执行操作: {action.kind} (数据: {action_data})")
 
-        if action_type == "ting":
-            if player.is_listening:
-                self.send_message_to_player(player_id, {"type": "error", "message": "已叫听"})
-                return
-            if player.is_attempting_ting:
-                self.send_message_to_player(player_id, {"type": "error", "message": "已在尝试听牌，请打牌"})
-                return
-            if len(player.hand) % 3 != 2:  # 摸牌后应为 3n+2
-                self.send_message_to_player(player_id, {"type": "error", "message": "手牌数错误无法叫听"})
-                return
-            player.is_attempting_ting = True
-            logger.info(f"玩家 {player.name} 声明尝试听牌。等待其打出一张牌以确认。")
-            message = {
-                "type": "action_prompt", "actions": ["discard"],
-                "drawn_tile": player.current_drawn_tile_for_auto_discard,
-                "is_listening_player_turn": False,
-                "prompt_for_ting_discard": True
-            }
-            self._next_prompt_info = (player.player_id, message)
+        handler = self._action_handlers.get(action.kind)
+        if handler is None:
+            self.send_message_to_player(player_id, {"type": "error", "message": f"未知行动类型: {action.kind}"})
+            self._reprompt_player(player)
             return
+        handler(player, action)
 
-        elif action_type == "discard":
-            tile_to_discard = action_data.get("tile")
-            if not tile_to_discard or tile_to_discard not in player.hand:
-                self.send_message_to_player(player_id, {"type": "error", "message": "无效弃牌或牌不在手中"})
-                self._start_player_turn_logic(self.current_turn,
-                                              drawn_tile_override=player.current_drawn_tile_for_auto_discard)
-                return
-
-            if player.is_listening:
-                if tile_to_discard != player.current_drawn_tile_for_auto_discard:
-                    tile_to_discard = player.current_drawn_tile_for_auto_discard
-                    if tile_to_discard is None or tile_to_discard not in player.hand:
-                        self.end_game(f"玩家 {player.name} 状态异常导致游戏错误")
-                        return
-
-            player.remove_tile(tile_to_discard)
-            # 移除过水相关:
-            # if self.game_rules.enable_passed_hu_rule: ...
-
-            self.discard_pile.append(tile_to_discard)
-            player.discarded.append(tile_to_discard)
-            self.last_discarded_tile = tile_to_discard
-            self.last_discarder_id = player_id
-            logger.info(f"{player.name} 打出了 {tile_to_discard}")
-            player.current_drawn_tile_for_auto_discard = None
-
-            self.broadcast_message({"type": "player_discarded", "player_id": player_id, "tile": tile_to_discard})
-
-            if player.is_attempting_ting:
-                player.is_attempting_ting = False
-                current_listens = player.find_listening_tiles(game_rules=self.game_rules, hand_to_check=player.hand)
-                if current_listens:
-                    player.is_listening = True
-                    player.listening_tiles = list(current_listens)
-                    player.fixed_listening_tiles = list(current_listens)
-                    logger.info(
-                        f"玩家 {player.name} 打出 {tile_to_discard} 后成功听牌，听: {player.fixed_listening_tiles}")
-                    self.broadcast_message({"type": "player_tinged", "player_id": player_id,
-                                            "listening_tiles": player.fixed_listening_tiles})
-                else:
-                    player.is_listening = False;
-                    player.listening_tiles = [];
-                    player.fixed_listening_tiles = []
-                    logger.info(f"玩家 {player.name} 打出 {tile_to_discard} 后未能听牌。听牌尝试失败。")
-                    self.send_message_to_player(player_id, {"type": "info", "message": "打牌后未能听牌，听牌取消。"})
-
-            self.check_other_players_actions()
+    def _handle_ting_action(self, player, action):
+        player_id = player.player_id
+        if player.is_listening:
+            self.send_message_to_player(player_id, {"type": "error", "message": "已叫听"})
+            return
+        if player.is_attempting_ting:
+            self.send_message_to_player(player_id, {"type": "error", "message": "已在尝试听牌，请打牌"})
+            return
+        if player.hand_size % 3 != 2:  # 摸牌后应为 3n+2
+            self.send_message_to_player(player_id, {"type": "error", "message": "手牌数错误无法叫听"})
+            return
+        player.is_attempting_ting = True
+        logger.info(f"玩家 {player.name} 声明尝试听牌。等待其打出一张牌以确认。")
+        message = {
+            "type": "action_prompt", "actions": ["discard"],
+            "drawn_tile": _tile_str(player.current_drawn_tile_for_auto_discard),
+            "is_listening_player_turn": False,
+            "prompt_for_ting_discard": True
+        }
+        self._set_action_prompt(player.player_id, message)
+
+    def _handle_discard_action(self, player, action):
+        player_id = player.player_id
+        tile_to_discard = action.tile
+        if tile_to_discard is None or not player.hand_counts[tile_to_discard]:
+            self.send_message_to_player(player_id, {"type": "error", "message": "无效弃牌或牌不在手中"})
+            self._reprompt_player(player)
             return
 
-        elif action_type == "hu":
-            if player.can_hu_zimo:
-                win_desc = "自摸"
-                self.end_game(f"{player.name} {win_desc}胡了！", winner_id=player_id,
-                              winning_tile=player.current_drawn_tile_for_auto_discard or win_desc)
-                return
-            else:
-                self.send_message_to_player(player_id, {"type": "error", "message": "当前不能胡牌"})
-                self._start_player_turn_logic(self.current_turn,
-                                              drawn_tile_override=player.current_drawn_tile_for_auto_discard)
-                return
-
-        elif action_type == "gang":
-            gang_type = action_data.get("gang_type")
-            tile_info = action_data.get("tile_info")
-
-            possible_an_for_player = player.possible_an_gangs
-            possible_bu_for_player = player.possible_bu_gangs
-
-            is_valid_gang_choice = False
-            if gang_type == "an" and tile_info in possible_an_for_player:
-                is_valid_gang_choice = True
-            elif gang_type == "bu" and tile_info in possible_bu_for_player:
-                is_valid_gang_choice = True
-
-            if not is_valid_gang_choice:
-                self.send_message_to_player(player_id, {"type": "error", "message": "无效的杠牌选择"})
-                self._start_player_turn_logic(self.current_turn,
-                                              drawn_tile_override=player.current_drawn_tile_for_auto_discard)
-                return
-
-            success = player.perform_gang(gang_type, tile_info, game_rules=self.game_rules)
-            if success:
-                g_tile_display = tile_info if gang_type == 'an' else tile_info[1]
-                self.broadcast_message(
-                    {"type": "player_ganged", "player_id": player.player_id, "tile": g_tile_display,
-                     "gang_type": gang_type, "melds": player.melds})
-                self._draw_and_handle_gang_replacement_logic(player)
-                return
+        if player.is_listening:
+            if tile_to_discard != player.current_drawn_tile_for_auto_discard:
+                tile_to_discard = player.current_drawn_tile_for_auto_discard
+                if tile_to_discard is None or not player.hand_counts[tile_to_discard]:
+                    self.end_game(f"玩家 {player.name} 状态异常导致游戏错误")
+                    return
+
+        player.remove_tile(tile_to_discard)
+        self._last_action_prompt = None  # 状态已改变，之前的提示作废
+        # 移除过水相关:
+        # if self.game_rules.enable_passed_hu_rule: ...
+
+        self.discard_pile.append(tile_to_discard)
+        player.discarded.append(tile_to_discard)
+        self.last_discarded_tile = tile_to_discard
+        self.last_discarder_id = player_id
+        logger.info(f"{player.name} 打出了 {ID_TO_TILE[tile_to_discard]}")
+        player.current_drawn_tile_for_auto_discard = None
+
+        self.broadcast_message({"type": "player_discarded", "player_id": player_id,
+                                "tile": ID_TO_TILE[tile_to_discard]})
+
+        if player.is_attempting_ting:
+            player.is_attempting_ting = False
+            # 只考虑还可能出现的牌：所有张都已现身（牌池、亮牌、自己手中）的牌不算听
+            supply = self.remaining_supply(player)
+            current_listens = player.find_listening_tiles(
+                tuple(tile for tile in self.all_game_tiles_list if supply[tile]))
+            if current_listens:
+                player.is_listening = True
+                player.listening_tiles = sorted(current_listens)
+                player.fixed_listening_tiles = list(player.listening_tiles)
+                player.fixed_listening_tiles_set = current_listens
+                logger.info(
+                    f"玩家 {player.name} 打出 {ID_TO_TILE[tile_to_discard]} 后成功听牌，听: {_tile_strs(player.fixed_listening_tiles)}")
+                self.broadcast_message({"type": "player_tinged", "player_id": player_id,
+                                        "listening_tiles": _tile_strs(player.fixed_listening_tiles)})
             else:
-                self.send_message_to_player(player_id, {"type": "error", "message": "执行杠操作失败"})
-                self._start_player_turn_logic(self.current_turn,
-                                              drawn_tile_override=player.current_drawn_tile_for_auto_discard)
-                return
+                player.is_listening = False;
+                player.listening_tiles = [];
+                player.fixed_listening_tiles = []
+                player.fixed_listening_tiles_set = frozenset()
+                logger.info(f"玩家 {player.name} 打出 {ID_TO_TILE[tile_to_discard]} 后未能听牌。听牌尝试失败。")
+                self.send_message_to_player(player_id, {"type": "info", "message": "打牌后未能听牌，听牌取消。"})
+
+        self.check_other_players_actions()
+
+    def _handle_hu_action(self, player, action):
+        if player.can_hu_zimo:
+            win_desc = "自摸"
+            drawn_tile = player.current_drawn_tile_for_auto_discard
+            self.end_game(f"{player.name} {win_desc}胡了！", winner_id=player.player_id,
+                          winning_tile=ID_TO_TILE[drawn_tile] if drawn_tile is not None else win_desc)
         else:
-            self.send_message_to_player(player_id, {"type": "error", "message": f"未知行动类型: {action_type}"})
-            self._start_player_turn_logic(self.current_turn,
-                                          drawn_tile_override=player.current_drawn_tile_for_auto_discard)
+            self.send_message_to_player(player.player_id, {"type": "error", "message": "当前不能胡牌"})
+            self._reprompt_player(player)
+
+    def _handle_gang_action(self, player, action):
+        gang_type = action.gang_type
+        tile_info = action.tile_info
+
+        possible_an_for_player = player.possible_an_gangs
+        possible_bu_for_player = player.possible_bu_gangs
+
+        is_valid_gang_choice = False
+        if gang_type == "an" and tile_info in possible_an_for_player:
+            is_valid_gang_choice = True
+        elif gang_type == "bu" and tile_info in possible_bu_for_player:
+            is_valid_gang_choice = True
+
+        if not is_valid_gang_choice:
+            self.send_message_to_player(player.player_id, {"type": "error", "message": "无效的杠牌选择"})
+            self._reprompt_player(player)
             return
 
+        success = player.perform_gang(gang_type, tile_info)
+        if success:
+            self._last_action_prompt = None
+            g_tile_display = tile_info if gang_type == 'an' else tile_info[1]
+            self.broadcast_message(
+                {"type": "player_ganged", "player_id": player.player_id, "tile": ID_TO_TILE[g_tile_display],
+                 "gang_type": gang_type, "melds": _melds_strs(player.melds)})
+            self._draw_and_handle_gang_replacement_logic(player)
+        else:
+            self.send_message_to_player(player.player_id, {"type": "error", "message": "执行杠操作失败"})
+            self._reprompt_player(player)
+
     def _draw_and_handle_gang_replacement_logic(self, player):  # 保持大部分不变
         if self.game_state != "playing": return False
         replacement_tile = self.deck.draw_from_end()
-        if not replacement_tile:
+        if replacement_tile is None:
             self.end_game("杠后无牌可摸 (流局)")
             return False
         player.add_tile(replacement_tile)
-        logger.debug(f"{player.name} 杠后补到: {replacement_tile} (手牌: {player.hand})")
-        self._start_player_turn_logic(self.get_player_index_by_id(player.player_id),
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("%s 杠后补到: %s (手牌: %s)", player.name, ID_TO_TILE[replacement_tile], _tile_strs(player.hand))
+        self._start_player_turn_logic(self._pid_to_index[player.player_id],
                                       drawn_tile_override=replacement_tile,
                                       is_gang_replacement_draw=True)
         return True
@@ -657,132 +933,179 @@ class Game:  # Game 类中的大部分逻辑保持，但其调用的 Player 方
     def check_other_players_actions(self):  # 移除过水相关
         discarded_tile = self.last_discarded_tile
         discarder_id = self.last_discarder_id
-        if not discarded_tile or discarder_id is None: self._advance_turn_logic(); return
+        if discarded_tile is None or discarder_id is None: self._advance_turn_logic(); return
 
         possible_actions_for_players = {}
-        self.action_responses = {}
         action_found_for_any_player = False
-        discarder_index = self.get_player_index_by_id(discarder_id)
+        discarder_index = self._pid_to_index.get(discarder_id, -1)
         if discarder_index == -1: self._advance_turn_logic(); return
 
-        for i in range(1, self.num_players):
-            player_index = (discarder_index + i) % self.num_players
-            player = self.players[player_index]
+        # 听牌玩家的胡牌张就是其固定听牌，直接查表；其余玩家先用计数向量做廉价预筛：碰至少要有2张，
+        # 明杠要有3张，胡牌则要求弃牌能与该玩家已有的牌组成面子或对子；只对通过预筛的座位做完整检查
+        num_players = self.num_players
+        players = self.players
+        candidate_seats = []
+        for i in range(1, num_players):
+            player_index = (discarder_index + i) % num_players
+            player = players[player_index]
+            if player.is_listening:
+                if discarded_tile in player.fixed_listening_tiles_set:
+                    candidate_seats.append(player_index)
+            elif player.hand_counts[discarded_tile] >= 2 or player.may_win_with(discarded_tile):
+                candidate_seats.append(player_index)
+
+        if not candidate_seats:  # 常见情况：没有人能响应，直接进入下一回合
+            self._reset_action_state_logic()
+            self._advance_turn_logic()
+            return
+
+        for player_index in candidate_seats:
+            player = players[player_index]
             player_actions_available = []
-            player.can_hu_discard = False;
-            player.can_gang = False;
-            player.can_pong = False
-
-            if player.can_hu_tile(tile_to_win=discarded_tile, is_zimo=False, game_rules=self.game_rules):
-                player_actions_available.append("hu");
-                player.can_hu_discard = True
-
-            if not player.is_listening:
-                _, _, possible_ming = player.find_possible_gangs(tile_from_discard=discarded_tile,
-                                                                 game_rules=self.game_rules)
-                if possible_ming: player_actions_available.append("gang"); player.can_gang = True
-                if player.can_pong_tile(discarded_tile, game_rules=self.game_rules):
-                    player_actions_available.append("pong");
-                    player.can_pong = True
+            can_flags = 0
+
+            if player.is_listening:  # 已在预筛中确认弃牌是其听牌，听牌后不能碰/杠
+                player_actions_available.append("hu")
+                can_flags = CAN_HU
+            else:
+                if player.wins_with(discarded_tile):
+                    player_actions_available.append("hu")
+                    can_flags |= CAN_HU
+                held_count = player.hand_counts[discarded_tile]
+                if held_count == 3:
+                    player_actions_available.append("gang")
+                    can_flags |= CAN_GANG
+                if held_count >= 2:
+                    player_actions_available.append("pong")
+                    can_flags |= CAN_PONG
+            player.can_flags = can_flags
 
             if player_actions_available:
                 possible_actions_for_players[player.player_id] = player_actions_available
-                self.action_responses[player.player_id] = None
+                self._pending_mask |= 1 << player_index
+                self._allowed_responses[player_index] = frozenset(player_actions_available).union(("pass",))
                 action_found_for_any_player = True
 
         if action_found_for_any_player:
             self.action_pending = True
-            self._pending_action_info = {"type": "discard_response", "discarded_tile": discarded_tile,
-                                         "discarder_id": discarder_id}
+            self._pending_action_info = PendingAction("discard_response", discarded_tile, discarder_id,
+                                                     discarder_index)
+            # 除 actions 外各玩家的响应提示相同，先建好公共部分，每人复制后只填 actions
+            base_message = {"type": "action_prompt", "tile": ID_TO_TILE[discarded_tile],
+                            "discarder_id": discarder_id, "is_response_prompt": True}
             for p_id, actions_list in possible_actions_for_players.items():
-                final_actions_list = list(actions_list)
-                if "pass" not in final_actions_list: final_actions_list.append("pass")
-                message = {"type": "action_prompt", "actions": final_actions_list, "tile": discarded_tile,
-                           "discarder_id": discarder_id, "is_response_prompt": True}
+                actions_key = tuple(actions_list)
+                final_actions_list = _response_prompt_actions.get(actions_key)
+                if final_actions_list is None:
+                    final_actions_list = actions_key if "pass" in actions_key else actions_key + ("pass",)
+                    _response_prompt_actions[actions_key] = final_actions_list
+                message = base_message.copy()
+                message["actions"] = final_actions_list
                 self.send_message_to_player(p_id, message)
         else:
             self._reset_action_state_logic()
             self._advance_turn_logic()
 
     def handle_action_response(self, player_id, response_data):  # 移除过水相关
-        if not self.action_pending or self._pending_action_info.get("type") != "discard_response": return
-        if player_id not in self.action_responses or self.action_responses.get(player_id) is not None: return
-
-        player = self.get_player_by_id(player_id)
-        if not player: return
+        if not self.action_pending or self._pending_action_info.kind != "discard_response": return
+        seat = self._pid_to_index.get(player_id, -1)
+        if seat == -1 or not self._pending_mask >> seat & 1: return
+        player = self.players[seat]
 
         response_type = response_data.get("action_type")
-        discarded_tile_for_action = self._pending_action_info["discarded_tile"]
-        allowed_server_side = ["pass"]
-        if player.can_hu_discard: allowed_server_side.append("hu")
-        if player.can_gang: allowed_server_side.append("gang")
-        if player.can_pong: allowed_server_side.append("pong")
-
-        if response_type not in allowed_server_side: response_type = "pass"
+        discarded_tile_for_action = self._pending_action_info.discarded_tile
+        if response_type not in self._allowed_responses[seat]: response_type = "pass"
 
         # 移除过水相关:
         # if self.game_rules.enable_passed_hu_rule: ...
 
-        self.action_responses[player_id] = response_type
-        logger.info(f"玩家 {player.name} 响应对 {discarded_tile_for_action} 的操作: {response_type}")
+        self.action_responses[seat] = _RESPONSE_CODES[response_type]
+        self._pending_mask &= ~(1 << seat)
+        logger.info("玩家 %s 响应对 %s 的操作: %s", player.name, ID_TO_TILE[discarded_tile_for_action], response_type)
 
-        if all(response is not None for response in self.action_responses.values()):
+        if self._pending_mask and response_type == "hu" and self._hu_decided_by(seat):
+            self._cancel_pending_responses()
+        if not self._pending_mask:
             self._resolve_pending_actions_logic()
         return
 
+    def _hu_decided_by(self, seat):
+        """座位 seat 已响应胡时，若离放炮者更近的座位中没有仍在等待且可胡的，结果已定 (胡优先级最高)。"""
+        num_players = self.num_players
+        discarder_idx = self._pending_action_info.discarder_idx
+        for i in range(1, num_players):
+            p_idx = (discarder_idx + i) % num_players
+            if p_idx == seat:
+                return True
+            if self._pending_mask >> p_idx & 1 and "hu" in self._allowed_responses[p_idx]:
+                return False
+        return True
+
+    def _cancel_pending_responses(self):
+        """不再等待其余座位的响应，通知他们撤下响应提示。"""
+        for seat in range(self.num_players):
+            if self._pending_mask >> seat & 1:
+                self.send_message_to_player(self.players[seat].player_id, {"type": "action_cancelled"})
+        self._pending_mask = 0
+
     def _resolve_pending_actions_logic(self):  # 保持不变
         if not self.action_pending: return
-        discarded_tile = self._pending_action_info["discarded_tile"]
-        discarder_id = self._pending_action_info["discarder_id"]
-        discarder_idx = self.get_player_index_by_id(discarder_id)
-
-        hu_pid, gang_po, pong_po = None, None, None
-        for i in range(1, self.num_players):
-            p_idx = (discarder_idx + i) % self.num_players
-            p_obj = self.players[p_idx]
-            resp = self.action_responses.get(p_obj.player_id)
-            if resp == "hu":
-                if hu_pid is None: hu_pid = p_obj.player_id
-        if hu_pid:
-            winner = self.get_player_by_id(hu_pid)
-            self.end_game(f"{winner.name} 接炮胡！", hu_pid, discarded_tile)
+        discarded_tile = self._pending_action_info.discarded_tile
+        discarder_idx = self._pending_action_info.discarder_idx
+
+        # 从放炮者下家起只遍历一次，取编码最小 (优先级最高) 的响应；同级时先遇到的座位优先
+        best_resp, best_seat = None, -1
+        num_players = self.num_players
+        action_responses = self.action_responses
+        for i in range(1, num_players):
+            p_idx = (discarder_idx + i) % num_players
+            resp = action_responses[p_idx]
+            if resp >= _RESPONSE_HU and (best_resp is None or resp < best_resp):
+                best_resp, best_seat = resp, p_idx
+        best_player = self.players[best_seat] if best_resp is not None else None
+
+        if best_resp == _RESPONSE_HU:
+            self.end_game(f"{best_player.name} 接炮胡！", best_player.player_id, ID_TO_TILE[discarded_tile])
             self._reset_action_state_logic();
             return
 
-        for i in range(1, self.num_players):  # 再看杠/碰
-            p_idx = (discarder_idx + i) % self.num_players
-            p_obj = self.players[p_idx]
-            resp = self.action_responses.get(p_obj.player_id)
-            if resp == "gang":
-                if gang_po is None: gang_po = p_obj
-            if resp == "pong" and gang_po is None:
-                if pong_po is None: pong_po = p_obj
-
         action_taken = False
-        if gang_po:
-            if gang_po.perform_gang("ming", discarded_tile, discarded_tile, self.game_rules):
-                self.broadcast_message({"type": "player_ganged", "player_id": gang_po.player_id, "tile": discarded_tile,
-                                        "gang_type": "ming", "melds": gang_po.melds})
-                self.current_turn = self.get_player_index_by_id(gang_po.player_id)
-                self._draw_and_handle_gang_replacement_logic(gang_po)
-                action_taken = True
-        elif pong_po:
-            if pong_po.perform_pong(discarded_tile):
-                self.broadcast_message({"type": "player_ponged", "player_id": pong_po.player_id, "tile": discarded_tile,
-                                        "melds": pong_po.melds})
-                self.current_turn = self.get_player_index_by_id(pong_po.player_id)
-                self._next_prompt_info = (pong_po.player_id,
-                                          {"type": "action_prompt", "actions": ["discard"], "from_pong_gang": True})
-                action_taken = True
+        if best_resp == _RESPONSE_GANG:
+            # 只有询问响应时确认过可杠/可碰的座位才会作出该响应，因此直接亮牌，不再重复校验手牌
+            gang_po = best_player
+            assert gang_po.can_flags & CAN_GANG
+            gang_po.claim_discard_unchecked(discarded_tile, 4)
+            self.discard_pile.pop()  # 被杠走的弃牌已计入亮牌，不再留在牌池中
+            self.broadcast_message({"type": "player_ganged", "player_id": gang_po.player_id,
+                                    "tile": ID_TO_TILE[discarded_tile], "gang_type": "ming",
+                                    "melds": _melds_strs(gang_po.melds)})
+            self.current_turn = self._pid_to_index[gang_po.player_id]
+            self._draw_and_handle_gang_replacement_logic(gang_po)
+            action_taken = True
+        elif best_resp == _RESPONSE_PONG:
+            pong_po = best_player
+            assert pong_po.can_flags & CAN_PONG
+            pong_po.claim_discard_unchecked(discarded_tile, 3)
+            self.discard_pile.pop()  # 被碰走的弃牌已计入亮牌，不再留在牌池中
+            self.broadcast_message({"type": "player_ponged", "player_id": pong_po.player_id,
+                                    "tile": ID_TO_TILE[discarded_tile], "melds": _melds_strs(pong_po.melds)})
+            self.current_turn = self._pid_to_index[pong_po.player_id]
+            self._set_action_prompt(pong_po.player_id,
+                                    {"type": "action_prompt", "actions": ["discard"], "from_pong_gang": True})
+            action_taken = True
 
         self._reset_action_state_logic()
         if not action_taken: self._advance_turn_logic()
 
-    def _reset_action_state_logic(self):  # 保持不变
+    def _reset_action_state_logic(self):
         self.action_pending = False;
-        self.action_responses = {};
         self._pending_action_info = None
-        for p in self.players: p.can_pong = False; p.can_gang = False; p.can_hu_discard = False
+        if self.game_state == "finished":  # 游戏已结束，各座位的响应状态不会再被读取，不必逐一清除
+            return
+        self.action_responses[:] = self._idle_responses
+        self._allowed_responses[:] = self._no_allowed_responses
+        self._pending_mask = 0
+        for p in self.players: p.can_flags = 0
 
     def _advance_turn_logic(self):  # 保持不变
         if self.game_state != "playing": return
@@ -795,15 +1118,15 @@ class Game:  # Game 类中的大部分逻辑保持，但其调用的 Player 方
         self.game_state = "finished"
         self.winning_player_id = winner_id
         self.winning_tile = winning_tile
-        logger.info(f"--- 游戏结束！ 原因: {reason} ---")
+        logger.info("--- 游戏结束！ 原因: %s ---", reason)
         # ... (日志部分不变) ...
-        final_hands_info = {}
-        for p in self.players:
-            final_hands_info[str(p.player_id)] = {
-                "hand": p.hand, "melds": p.melds,
+        final_hands_info = {
+            p.player_id_str: {
+                "hand": _tile_strs(p.hand), "melds": _melds_strs(p.melds),
                 "is_listening": p.is_listening,
-                "listening_tiles": p.listening_tiles if p.is_listening else []
-            }
+                "listening_tiles": _tile_strs(p.listening_tiles) if p.is_listening else []
+            } for p in self.players
+        }
         final_state_msg = {
             "type": "game_over", "reason": reason,
             "winning_player_id": winner_id, "winning_tile": winning_tile,
@@ -816,4 +1139,5 @@ class Game:  # Game 类中的大部分逻辑保持，但其调用的 Player 方
         pass
 
     def broadcast_message(self, message):
+        """由服务器替换为实际的广播实现。消息会被一次性编码后发给所有客户端，调用后不要再修改 message。"""
         pass
\ No newline at end of file
@@ -1,23 +1,77 @@
 # mahjong_server.py
 # 麻将游戏服务器主程序，处理连接、游戏循环和通信
 
+import os
 import socket
 import threading
+import queue
 import time
 import json
 import logging
 import traceback
-from mahjong_common import send_json, receive_json
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from mahjong_common import send_json, receive_frame, encode_json_frame, send_frame, encode_json_bytes, encode_batch_frame
 from mahjong_game import Game, Player, GameRules # 确保 GameRules 被导入
 
 # 服务器监听地址和端口
 SERVER_HOST = '0.0.0.0'  # 监听所有可用网络接口
 SERVER_PORT = 12345  # 监听端口
+# 游戏主循环等待玩家输入的最长时间（秒）。玩家输入、加入和断线都经输入队列唤醒主循环，超时只是兜底检查
+INPUT_WAIT_TIMEOUT = 1.0
+# 服务器线程（每个客户端一个接收线程 + 游戏主循环）只运行浅层的 Python 代码，不需要默认的 8MB 线程栈
+THREAD_STACK_SIZE = 512 * 1024
+# 客户端接收缓冲区大小（字节），客户端消息都很小，一次 recv 可读入多条
+RECV_BUFFER_SIZE = 64 * 1024
+# 新连接发送连接请求的最长等待时间（秒）。客户端线程池大小有限，空闲连接不能无限期占用线程而挡住后来的玩家
+CONNECT_TIMEOUT = 10.0
+# 多核 Linux 上把游戏主循环固定在一个 CPU 上 (Game 的数据常驻该 CPU 缓存)，客户端线程使用其余 CPU；设为 False 则不设置
+PIN_GAME_LOOP_CPU = True
+# 客户端 socket 的内核发送缓冲区大小（字节），客户端偶尔读得慢时 sendall 也不必阻塞游戏主循环
+SEND_BUFFER_SIZE = 256 * 1024
 
 # 获取服务器主模块的日志记录器
 logger = logging.getLogger(__name__)
 
 
+def _split_cpus():
+    """返回 (游戏主循环的 CPU 集合, 客户端线程的 CPU 集合)；平台不支持、未启用或只有一个可用 CPU 时返回 (None, None)。"""
+    if not PIN_GAME_LOOP_CPU or not hasattr(os, "sched_setaffinity"):
+        return None, None
+    cpus = sorted(os.sched_getaffinity(0))
+    if len(cpus) < 2:
+        return None, None
+    return {cpus[0]}, set(cpus[1:])
+
+
+def _set_thread_affinity(cpus):
+    """把调用线程限制在 cpus 上运行（Linux 上 pid 0 指调用线程）；cpus 为 None 时不做任何事。"""
+    if not cpus:
+        return
+    try:
+        os.sched_setaffinity(0, cpus)
+    except OSError as e:
+        logger.warning(f"设置线程 CPU 亲和性失败: {e}")
+
+
+@lru_cache(maxsize=None)
+def _error_frame(message_text):
+    """拒绝连接时发送的错误消息只有几种固定文本，每种只编码一次。"""
+    return encode_json_frame({"type": "error", "message": message_text})
+
+
+class _LazyPlayerName:
+    """作为 %-style 日志参数传入：只有日志真正输出时才调用 get_player_name_from_id_unsafe（需要加锁）。"""
+    __slots__ = ("server", "player_id")
+
+    def __init__(self, server, player_id):
+        self.server = server
+        self.player_id = player_id
+
+    def __str__(self):
+        return self.server.get_player_name_from_id_unsafe(self.player_id)
+
+
 class MahjongServer:
     """麻将服务器类，管理客户端连接和游戏实例。"""
 
@@ -26,61 +80,63 @@ class MahjongServer:
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.clients = {}
-        self.players = [] # Player 对象列表
+        self._players_by_id = {} # player_id -> Player 对象，按加入顺序
         self.game = None
         self._player_counter = 0
         self._lock = threading.Lock()
         self._game_instance_exists = False
         self._game_started_actual = False
-        self._pending_client_input = None
+        # 客户端线程放入 (输入类型, player_id, 数据)，由游戏主循环按顺序取出处理。
+        # 游戏开始后只有游戏主循环线程读写 Game，其他线程的请求（包括玩家断线）都经此队列转交
+        self._input_queue = queue.Queue()
         self._shutdown_requested = threading.Event()
+        # 游戏主循环每处理一轮时，把发出的消息先按玩家合并，轮末每个客户端只发送一帧 (见 _begin_batch)
+        self._batch_local = threading.local()
+        self._client_pool = None # 客户端处理线程池，在 configure_game 中按玩家人数创建
+        self._game_loop_cpus, self._client_cpus = _split_cpus()
+        # player_id -> 上次发给该玩家的 game_state 编码，内容未变时不再重复发送 (只由游戏主循环线程读写)
+        self._last_state_bytes = {}
 
     def run(self):
         """启动服务器，监听连接，并管理线程。"""
         try:
             self.server_socket.bind((SERVER_HOST, SERVER_PORT))
-            self.server_socket.settimeout(1.0)
             self.server_socket.listen(5)
             logger.info(f"服务器在 {SERVER_HOST}:{SERVER_PORT} 监听...")
 
-            game_thread = threading.Thread(target=self.game_loop, name="GameLoopThread", daemon=True)
-            game_thread.start()
-            logger.debug("游戏主循环线程已启动。")
-
+            # 先完成配置再启动游戏主循环，主循环启动时 Game 实例已经存在
             self.configure_game() # 配置游戏规则 (现在是硬编码)
             if not self._game_instance_exists:
                 logger.error("游戏配置失败或被跳过，服务器即将退出。")
                 self._shutdown_requested.set()
                 return
 
-            client_threads = []
-            logger.info("开始接受客户端连接...")
-            while not self._shutdown_requested.is_set():
-                try:
-                    conn, addr = self.server_socket.accept()
-                    logger.info(f"接受来自 {addr} 的连接")
-                    client_handler = threading.Thread(
-                        target=self.handle_client,
-                        args=(conn, addr),
-                        name=f"ClientThread-{addr}",
-                        daemon=True
-                    )
-                    client_handler.start()
-                    client_threads.append(client_handler)
-                except socket.timeout:
-                    continue
-                except Exception as e:
-                    if not self._shutdown_requested.is_set():
-                        logger.exception("接受连接时发生错误")
-                    break
-            logger.info("服务器停止接受新连接。")
+            game_thread = threading.Thread(target=self.game_loop, name="GameLoopThread", daemon=True)
+            game_thread.start()
+            logger.debug("游戏主循环线程已启动。")
+
+            accept_thread = threading.Thread(target=self._accept_loop, name="AcceptThread", daemon=True)
+            accept_thread.start()
+            self._shutdown_requested.wait() # 主线程只等待关闭请求
 
         except Exception as e:
             logger.exception("服务器运行时发生严重错误")
         finally:
             logger.info("开始服务器关闭流程...")
             self._shutdown_requested.set()
+            with self._lock:
+                remaining_conns = list(self.clients.values())
+            for conn in remaining_conns: # 让仍阻塞在 recv 中的客户端线程退出，线程池才能结束
+                try: conn.shutdown(socket.SHUT_RDWR)
+                except OSError: pass
+            if self._client_pool:
+                self._client_pool.shutdown(wait=False, cancel_futures=True)
             if self.server_socket:
+                try:
+                    # 唤醒阻塞在 accept() 中的接受连接线程
+                    self.server_socket.shutdown(socket.SHUT_RD)
+                except OSError:
+                    pass
                 try:
                     self.server_socket.close()
                     logger.info("服务器监听socket已关闭。")
@@ -88,6 +144,30 @@ class MahjongServer:
                     logger.error(f"关闭服务器监听socket时出错: {e}")
             logger.info("服务器关闭完成。")
 
+    def _accept_loop(self):
+        """专用的接受连接线程：阻塞在 accept() 上，连接到达即交给客户端线程池，不做超时轮询。"""
+        logger.info("开始接受客户端连接...")
+        while not self._shutdown_requested.is_set():
+            try:
+                conn, addr = self.server_socket.accept()
+            except OSError as e:
+                if not self._shutdown_requested.is_set():
+                    logger.exception("接受连接时发生错误")
+                break
+            logger.info(f"接受来自 {addr} 的连接")
+            # 每轮的消息已合并为每个客户端一帧，关闭 Nagle 算法让这一帧立即发出，不等待上一帧的 ACK
+            try:
+                conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                conn.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SEND_BUFFER_SIZE)
+            except OSError as e:
+                logger.warning(f"设置连接 {addr} 的 socket 选项失败: {e}")
+            try:
+                self._client_pool.submit(self.handle_client, conn, addr)
+            except RuntimeError: # 线程池已关闭
+                conn.close()
+                break
+        logger.info("服务器停止接受新连接。")
+
     def configure_game(self):
         """
         配置游戏规则 (硬编码)。
@@ -95,7 +175,7 @@ class MahjongServer:
         混儿牌: None (无混儿)
         其他规则采用 GameRules 的默认值。
         """
-        print("\n--- 正在配置游戏 (使用预设规则) ---")
+        logger.info("--- 正在配置游戏 (使用预设规则) ---")
         try:
             # 获取玩家人数
             while True:
@@ -105,9 +185,9 @@ class MahjongServer:
                     if 2 <= num_players <= 4:
                         break
                     else:
-                        print("人数必须在2到4之间。")
+                        logger.warning("人数必须在2到4之间。")
                 except ValueError:
-                    print("请输入有效的数字。")
+                    logger.warning("请输入有效的数字。")
 
             # 获取是否包含风牌和箭牌 (这个可以保留配置)
             while True:
@@ -116,7 +196,7 @@ class MahjongServer:
                     include_winds_dragons_config = (include_zh_fb_input == 'y')
                     break
                 else:
-                    print("请输入 'y' 或 'n'。")
+                    logger.warning("请输入 'y' 或 'n'。")
 
             # 固定规则配置
             game_rules_config = {
@@ -137,22 +217,22 @@ class MahjongServer:
                 self.game.broadcast_message = self.broadcast_message
                 self._game_instance_exists = True
 
+            # 玩家人数固定为 2-4，预先建好对应大小的线程池，不必为每个连接新建线程；
+            # 多留一个线程，玩家已满后仍能及时回复多余连接的 "玩家已满" 错误
+            self._client_pool = ThreadPoolExecutor(max_workers=num_players + 1, thread_name_prefix="ClientThread",
+                                                   initializer=_set_thread_affinity, initargs=(self._client_cpus,))
+
             logger.info(
                 f"游戏配置完成 ({num_players}人, 使用预设规则)。等待玩家加入...")
 
+            # UDP connect 不发送数据，只让内核选出对外的本机地址；不做 gethostbyname，避免启动时卡在 DNS 查询上
             try:
-                hostname = socket.gethostname()
-                try:
-                    s_temp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-                    s_temp.settimeout(0.1)
+                with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s_temp:
                     s_temp.connect(('10.255.255.255', 1))
                     local_ip = s_temp.getsockname()[0]
-                    s_temp.close()
-                except Exception:
-                    local_ip = socket.gethostbyname(hostname)
-                print(f"提示: 客户端可连接到 {local_ip}:{SERVER_PORT} (同网络) 或 127.0.0.1:{SERVER_PORT} (本机)")
-            except socket.gaierror:
-                print(f"提示: 无法自动获取本机IP, 请客户端手动输入服务器IP或 127.0.0.1 (本机)")
+                logger.info(f"提示: 客户端可连接到 {local_ip}:{SERVER_PORT} (同网络) 或 127.0.0.1:{SERVER_PORT} (本机)")
+            except OSError:
+                logger.info(f"提示: 无法自动获取本机IP, 请客户端手动输入服务器IP或 127.0.0.1 (本机)")
 
         except Exception as e:
             logger.exception("配置游戏时发生错误")
@@ -163,13 +243,17 @@ class MahjongServer:
         """处理单个客户端连接：认证、消息接收和状态管理。"""
         player_id = None
         player_name_base = f"未知玩家@{addr}"
+        player_name_log = player_name_base # 收到合法的连接请求后改为 "名称@IP"
         player_added_successfully = False
         message_to_send_self = None
         message_to_broadcast = None
+        rfile = conn.makefile('rb', buffering=RECV_BUFFER_SIZE) # 接收端使用缓冲读取器，由它在 C 中合并 recv
 
         try:
-            logger.debug(f"等待来自 {addr} 的连接消息...")
-            connect_message = receive_json(conn)
+            logger.debug("等待来自 %s 的连接消息...", addr)
+            conn.settimeout(CONNECT_TIMEOUT)
+            connect_message = receive_frame(rfile) # 超时时返回 None，按断开处理
+            conn.settimeout(None)
             if self._shutdown_requested.is_set():
                 logger.info(f"服务器关闭中，忽略来自 {addr} 的消息。")
                 return
@@ -185,13 +269,13 @@ class MahjongServer:
                 player_name_base = player_name_input # 用于 Player 对象
                 player_name_log = f"{player_name_input}@{addr[0]}" # 用于日志
 
-                logger.debug(f"玩家 {player_name_log} 请求连接，获取锁...")
+                logger.debug("玩家 %s 请求连接，获取锁...", player_name_log)
                 with self._lock:
-                    logger.debug(f"玩家 {player_name_log} 获取到锁。")
+                    logger.debug("玩家 %s 获取到锁。", player_name_log)
                     game_ready = self._game_instance_exists and not self._game_started_actual and self.game and self.game.game_state == "waiting"
                     can_add_player = False
                     if game_ready:
-                        can_add_player = len(self.players) < self.game.num_players
+                        can_add_player = len(self._players_by_id) < self.game.num_players
 
                     if self._shutdown_requested.is_set():
                         message_to_send_self = {"type": "error", "message": "服务器正在关闭"}
@@ -206,11 +290,13 @@ class MahjongServer:
                         # 注意：Player 对象现在直接在这里创建和添加
                         player_obj = Player(player_id, player_name_base) # 使用不带IP的名称创建Player对象
                         self.clients[player_id] = conn
-                        self.players.append(player_obj) # 添加Player对象到服务器的列表
+                        self._players_by_id[player_id] = player_obj # 添加Player对象到服务器的玩家表
                         if self.game: self.game.add_player(player_obj) # 添加Player对象到Game实例
+                        # 唤醒游戏主循环检查人数，最后一名玩家加入后立即开局
+                        self._input_queue.put_nowait(("player_joined", player_id, None))
 
                         player_added_successfully = True
-                        current_player_count = len(self.players)
+                        current_player_count = len(self._players_by_id)
                         total_player_count = self.game.num_players if self.game else 0
 
                         message_to_send_self = {"type": "connect_success", "player_id": player_id,
@@ -220,15 +306,18 @@ class MahjongServer:
                                                 "player_name": player_name_base} # 广播的也是不带IP的名称
                         logger.info(
                             f"玩家 {player_name_log} ({player_id}) 加入成功。({current_player_count}/{total_player_count})")
-                logger.debug(f"玩家 {player_name_log} 释放锁。")
+                logger.debug("玩家 %s 释放锁。", player_name_log)
 
             if message_to_send_self:
                 try:
-                    logger.debug(f"准备发送响应给 {player_name_log if player_id is None else self.get_player_name_from_id_unsafe(player_id)} ({player_id}): 类型={message_to_send_self.get('type')}")
-                    send_json(conn, message_to_send_self)
+                    logger.debug("准备发送响应给 %s (%s): 类型=%s",
+                                 player_name_log if player_id is None else _LazyPlayerName(self, player_id),
+                                 player_id, message_to_send_self.get('type'))
                     if message_to_send_self.get("type") == "error":
+                        send_frame(conn, _error_frame(message_to_send_self["message"]))
                         conn.close()
                         return
+                    send_json(conn, message_to_send_self)
                 except Exception as e:
                     logger.error(f"发送响应给新玩家 {player_name_log} ({player_id}) 时失败: {e}")
                     if player_id is not None: self.remove_player(player_id)
@@ -245,42 +334,34 @@ class MahjongServer:
             # 主接收循环
             logger.info(f"玩家 {self.get_player_name_from_id_unsafe(player_id)} ({player_id}) 进入主消息接收循环...")
             while not self._shutdown_requested.is_set():
-                data = receive_json(conn)
+                data = receive_frame(rfile)
                 if self._shutdown_requested.is_set(): break
                 if data is None:
                     logger.info(f"玩家 {self.get_player_name_from_id_unsafe(player_id)} ({player_id}) 连接断开。")
                     break
 
-                input_queued = False
-                queue_debug_msg = ""
-                logger.debug(f"玩家 {player_id} 收到消息，尝试获取锁以放入队列...")
-                with self._lock:
-                    logger.debug(f"玩家 {player_id} 获取到锁。")
-                    if self._shutdown_requested.is_set(): break
-
-                    current_game_state_local = self.game.game_state if self.game else "no game"
-                    if self._game_started_actual and current_game_state_local == "playing":
-                        if data.get("type") in ["action", "action_response"]:
-                            if self._pending_client_input is not None:
-                                logger.warning(
-                                    f"玩家 {player_id} 发送了输入，但上一个输入未处理。旧输入将被覆盖！")
-                            self._pending_client_input = (data.get("type"), player_id, data)
-                            input_queued = True
-                            queue_debug_msg = f"DEBUG: 已将玩家 {player_id} 的输入 ({data.get('type')})放入待处理队列。"
-                        else:
-                            logger.warning(
-                                f"收到玩家 {player_id} 在 playing 状态下的非预期消息类型: {data.get('type')}")
+                # 不加锁：各属性读取在 GIL 下是原子的，Queue 本身线程安全；状态恰在此时改变也无妨，
+                # 游戏主循环取出输入时会再次检查游戏是否仍在进行，否则丢弃
+                message_type = data.get("type")
+                game = self.game
+                current_game_state_local = game.game_state if game else "no game"
+                if self._game_started_actual and current_game_state_local == "playing":
+                    if message_type in ("action", "action_response"):
+                        self._input_queue.put_nowait((message_type, player_id, data))
+                        logger.debug("已将玩家 %s 的输入 (%s) 放入待处理队列。", player_id, message_type)
                     else:
-                        logger.info(
-                            f"收到玩家 {player_id} 在非 playing 状态下的消息 ({data.get('type')})，状态: {current_game_state_local}。消息被忽略。")
-                logger.debug(f"玩家 {player_id} 释放锁。")
-                if input_queued: logger.debug(queue_debug_msg)
+                        logger.warning(
+                            f"收到玩家 {player_id} 在 playing 状态下的非预期消息类型: {message_type}")
+                else:
+                    logger.info(
+                        f"收到玩家 {player_id} 在非 playing 状态下的消息 ({message_type})，状态: {current_game_state_local}。消息被忽略。")
 
         except (ConnectionResetError, BrokenPipeError, socket.error) as e:
             logger.warning(f"玩家 {player_name_base if player_id is None else self.get_player_name_from_id_unsafe(player_id)} ({player_id}) 连接中断: {e}")
         except Exception as e:
             logger.exception(f"处理玩家 {player_name_base if player_id is None else self.get_player_name_from_id_unsafe(player_id)} ({player_id}) 时发生未知错误")
         finally:
+            rfile.close() # 只释放缓冲读取器对 socket 的引用，socket 本身在下面关闭
             logger.info(f"开始清理玩家 {player_name_base if player_id is None else self.get_player_name_from_id_unsafe(player_id)} ({player_id}) 的连接...")
             if player_id is not None:
                 self.remove_player(player_id)
@@ -294,25 +375,33 @@ class MahjongServer:
     def game_loop(self):
         """游戏主逻辑循环。"""
         logger.info("游戏主循环线程已启动。")
+        _set_thread_affinity(self._game_loop_cpus)
         while not self._shutdown_requested.is_set():
             action_to_process = None
             game_started_this_iteration = False
             game_ended_this_iteration = False
             prompt_to_send = None
             needs_broadcast = False
+            needs_reset_after_flush = False
             current_game_state_snapshot = None
 
+            # 阻塞等待玩家输入而不是固定休眠：输入到达后立即处理，空闲时最多等待 INPUT_WAIT_TIMEOUT
+            try:
+                queued_input = self._input_queue.get(timeout=INPUT_WAIT_TIMEOUT)
+            except queue.Empty:
+                queued_input = None
+
             logger.debug("GameLoop: 尝试获取锁...")
             with self._lock:
                 logger.debug("GameLoop: 获取到锁。")
                 if self._shutdown_requested.is_set(): break
 
                 current_game_state_snapshot = self.game.game_state if self.game else "no game"
-                logger.debug(
-                    f"GameLoop: 当前状态={current_game_state_snapshot}, 实例存在={self._game_instance_exists}, 游戏已启动={self._game_started_actual}")
+                logger.debug("GameLoop: 当前状态=%s, 实例存在=%s, 游戏已启动=%s",
+                             current_game_state_snapshot, self._game_instance_exists, self._game_started_actual)
 
                 if self._game_instance_exists and not self._game_started_actual and current_game_state_snapshot == "waiting":
-                    if len(self.players) == self.game.num_players:
+                    if len(self._players_by_id) == self.game.num_players:
                         logger.info("GameLoop: 玩家数量已满，尝试启动游戏...")
                         try:
                             success = self.game.start_game() # start_game 现在使用 GameRules
@@ -328,11 +417,14 @@ class MahjongServer:
                             self._reset_server_state_internal()
                             game_ended_this_iteration = True
 
-                if self._game_started_actual and current_game_state_snapshot == "playing" and self._pending_client_input:
-                    action_to_process = self._pending_client_input
-                    self._pending_client_input = None
-                    logger.debug(
-                        f"GameLoop: 获取到待处理输入: 类型={action_to_process[0]}, 玩家={action_to_process[1]}")
+                if queued_input is not None and queued_input[0] == "player_joined":
+                    pass # 只用于唤醒主循环，开局检查已在上面完成
+                elif queued_input is not None:
+                    if self._game_started_actual and current_game_state_snapshot == "playing":
+                        action_to_process = queued_input
+                        logger.debug("GameLoop: 获取到待处理输入: 类型=%s, 玩家=%s", action_to_process[0], action_to_process[1])
+                    else:
+                        logger.info(f"GameLoop: 游戏不在进行中 ({current_game_state_snapshot})，丢弃玩家 {queued_input[1]} 的输入。")
 
                 if self._game_instance_exists and current_game_state_snapshot == "finished":
                     game_ended_this_iteration = True
@@ -340,52 +432,51 @@ class MahjongServer:
                     self._reset_server_state_internal()
             logger.debug("GameLoop: 释放锁。")
 
+            self._begin_batch()
             if action_to_process and not game_ended_this_iteration:
                 input_type, player_id, data = action_to_process
-                player_name_log = self.get_player_name_from_id_unsafe(player_id)
-                logger.debug(f"GameLoop: 开始处理玩家 {player_name_log}({player_id}) 的输入: 类型={input_type}")
+                # 玩家名称要加锁查询，用 _LazyPlayerName 推迟到日志真正输出时
+                logger.debug("GameLoop: 开始处理玩家 %s(%s) 的输入: 类型=%s",
+                             _LazyPlayerName(self, player_id), player_id, input_type)
                 try:
                     if input_type == "action":
                         if self.game: self.game.handle_player_action(player_id, data)
                     elif input_type == "action_response":
                         if self.game: self.game.handle_action_response(player_id, data)
-                    logger.debug(f"GameLoop: 处理玩家 {player_id} 输入完成。")
+                    elif input_type == "disconnect":
+                        if self.game: self.game.end_game(f"玩家 {data['player_name']} 断开连接")
+                    logger.debug("GameLoop: 处理玩家 %s 输入完成。", player_id)
                 except Exception as e:
                     logger.exception(f"GameLoop: 处理游戏输入 {input_type} (玩家 {player_id}) 时发生错误")
-                    with self._lock:
-                        if self.game and self.game.game_state == "playing":
-                            self.game.end_game(f"服务器内部错误: {e}")
-                        game_ended_this_iteration = True
-                        current_game_state_snapshot = "finished" # 更新快照
-                        self._reset_server_state_internal()
+                    # end_game 会广播消息（需要获取锁），因此不在持有锁时调用；重置放到消息发出之后
+                    if self.game and self.game.game_state == "playing":
+                        self.game.end_game(f"服务器内部错误: {e}")
+                    game_ended_this_iteration = True
+                    needs_reset_after_flush = True
 
 
             if not game_ended_this_iteration:
-                logger.debug("GameLoop: 检查是否需要广播或发送提示，尝试获取锁...")
-                with self._lock:
-                    logger.debug("GameLoop: 获取到锁。")
-                    if self._shutdown_requested.is_set(): break
+                # 游戏开始后 Game 只由本线程修改，读取其状态不需要加锁
+                if self._shutdown_requested.is_set(): break
 
-                    current_game_state_snapshot = self.game.game_state if self.game else "no game"
-                    logger.debug(f"GameLoop: 检查时状态快照={current_game_state_snapshot}")
+                current_game_state_snapshot = self.game.game_state if self.game else "no game"
+                logger.debug("GameLoop: 检查时状态快照=%s", current_game_state_snapshot)
 
-                    if self._game_started_actual and current_game_state_snapshot == "playing":
-                        if game_started_this_iteration or action_to_process or (
-                                self.game and self.game._next_prompt_info):
-                            needs_broadcast = True
-                            logger.debug("GameLoop: 标记需要广播状态。")
+                if self._game_started_actual and current_game_state_snapshot == "playing":
+                    if game_started_this_iteration or action_to_process or (
+                            self.game and self.game._next_prompt_info):
+                        needs_broadcast = True
+                        logger.debug("GameLoop: 标记需要广播状态。")
 
-                        if self.game and self.game._next_prompt_info and not self.game.action_pending:
-                            prompt_to_send = self.game._next_prompt_info
-                            self.game._next_prompt_info = None
-                            logger.debug(
-                                f"GameLoop: 获取到待发送提示给玩家 {prompt_to_send[0]} 类型: {prompt_to_send[1].get('type')}")
+                    if self.game and self.game._next_prompt_info and not self.game.action_pending:
+                        prompt_to_send = self.game._next_prompt_info
+                        self.game._next_prompt_info = None
+                        logger.debug("GameLoop: 获取到待发送提示给玩家 %s 类型: %s",
+                                     prompt_to_send[0], prompt_to_send[1].get('type'))
 
-                    if current_game_state_snapshot == "finished": # 再次检查是否结束
-                        game_ended_this_iteration = True
-                        logger.info("GameLoop: 检测到游戏结束状态 (处理后)，准备重置服务器...")
-                        self._reset_server_state_internal()
-                logger.debug("GameLoop: 释放锁。")
+                if current_game_state_snapshot == "finished": # 再次检查是否结束
+                    game_ended_this_iteration = True
+                    needs_reset_after_flush = True
 
 
             if not game_ended_this_iteration:
@@ -396,16 +487,16 @@ class MahjongServer:
 
                 if prompt_to_send:
                     p_id, message = prompt_to_send
-                    logger.debug(f"GameLoop: 开始发送提示给玩家 {p_id}...")
+                    logger.debug("GameLoop: 开始发送提示给玩家 %s...", p_id)
                     self.send_message_to_player(p_id, message)
                     logger.debug("GameLoop: 提示发送完成。")
-            try:
-                sleep_duration = 0.1 if action_to_process or prompt_to_send or needs_broadcast else 0.2
-                time.sleep(sleep_duration)
-            except KeyboardInterrupt:
-                logger.info("GameLoop: 收到 KeyboardInterrupt，设置关闭标志。")
-                self._shutdown_requested.set()
-                break
+
+            # 本轮产生的消息（含 game_over）必须在重置关闭连接之前发出
+            self._flush_outgoing()
+            if needs_reset_after_flush:
+                with self._lock:
+                    logger.info("GameLoop: 检测到游戏结束状态 (处理后)，准备重置服务器...")
+                    self._reset_server_state_internal()
         logger.info("游戏主循环线程已退出。")
 
 
@@ -420,10 +511,12 @@ class MahjongServer:
             if player_obj: player_name = player_obj.name # 使用Player对象中的名称
 
         if conn:
+            if self._queue_outgoing(player_id, conn, message):
+                return True
             try:
                 # 日志中使用不带IP的名称
                 log_name = player_name.split('@')[0] if '@' in player_name else player_name
-                logger.debug(f"SEND -> {log_name} ({player_id}): 类型={message.get('type')}")
+                logger.debug("SEND -> %s (%s): 类型=%s", log_name, player_id, message.get('type'))
                 send_json(conn, message)
                 return True
             except Exception as e:
@@ -438,7 +531,10 @@ class MahjongServer:
             return False
 
     def broadcast_message(self, message):
-        """向所有当前连接的客户端广播消息。"""
+        """向所有当前连接的客户端广播同一条消息。消息只编码一次，调用后不应再修改 message。
+
+        按玩家定制的 game_state 由 broadcast_game_state 发送。
+        """
         disconnected_players = []
         clients_copy = {}
         with self._lock:
@@ -446,30 +542,25 @@ class MahjongServer:
             if not self.clients: return
             clients_copy = self.clients.copy()
 
-        logger.debug(f"BROADCAST: 类型={message.get('type')} -> {len(clients_copy)} 个客户端。")
+        logger.debug("BROADCAST: 类型=%s -> %d 个客户端。", message.get('type'), len(clients_copy))
 
-        for player_id, conn in clients_copy.items():
-            player_name_for_log = self.get_player_name_from_id_unsafe(player_id) # 获取不带IP的名称
-            message_to_send = message
+        # 消息对所有人相同，只编码一次
+        shared_bytes = encode_json_bytes(message)
+        batching = getattr(self._batch_local, "outgoing", None) is not None
+        shared_frame = None if batching else encode_batch_frame((shared_bytes,))
 
+        debug_enabled = logger.isEnabledFor(logging.DEBUG)
+        for player_id, conn in clients_copy.items():
             try:
-                if message.get("type") == "game_state":
-                    player_state = None
-                    with self._lock: # 再次获取锁以安全访问 game 对象
-                        if self._shutdown_requested.is_set(): continue
-                        if self.game and self.game.game_state == "playing": # 确保游戏进行中
-                            player_state = self.game.get_state_for_player(player_id)
-                            # player_name_for_log 已在上面获取
-                    if player_state:
-                        message_to_send = {"type": "game_state", "state": player_state}
-                    else:
-                        logger.debug(f"跳过向玩家 {player_id} 广播 game_state (无法获取状态)。")
-                        continue
-
-                logger.debug(f"BROADCAST -> {player_name_for_log} ({player_id}): 类型={message_to_send.get('type')}")
-                send_json(conn, message_to_send)
+                if batching:
+                    self._queue_outgoing(player_id, conn, message, shared_bytes)
+                    continue
+                if debug_enabled:  # 获取玩家名称需要加锁，只在输出调试日志时才获取
+                    logger.debug("BROADCAST -> %s (%s): 类型=%s", self.get_player_name_from_id_unsafe(player_id),
+                                 player_id, message.get('type'))
+                send_frame(conn, shared_frame)
             except Exception as e:
-                logger.error(f"广播消息给玩家 {player_name_for_log} ({player_id}) 失败: {e}")
+                logger.error(f"广播消息给玩家 {self.get_player_name_from_id_unsafe(player_id)} ({player_id}) 失败: {e}")
                 disconnected_players.append(player_id)
 
         if disconnected_players:
@@ -477,14 +568,75 @@ class MahjongServer:
             for p_id in disconnected_players:
                 self.remove_player(p_id)
 
+    def _begin_batch(self):
+        """开始在当前线程合并待发送的消息，直到 _flush_outgoing 为止。"""
+        self._batch_local.outgoing = {}
+
+    def _queue_outgoing(self, player_id, conn, message, encoded_message=None):
+        """若当前线程正在合并消息，则把消息加入该玩家的待发送列表并返回 True；否则返回 False，由调用者立即发送。"""
+        outgoing = getattr(self._batch_local, "outgoing", None)
+        if outgoing is None:
+            return False
+        if encoded_message is None:
+            encoded_message = encode_json_bytes(message)
+        outgoing.setdefault(player_id, (conn, []))[1].append(encoded_message)
+        return True
+
+    def _flush_outgoing(self):
+        """把当前线程合并的消息发出：每个客户端一帧，多条消息包装为 {"type": "batch", "messages": [...]}。"""
+        outgoing = getattr(self._batch_local, "outgoing", None)
+        self._batch_local.outgoing = None
+        if not outgoing: return
+
+        disconnected_players = []
+        for player_id, (conn, encoded_messages) in outgoing.items():
+            try:
+                logger.debug("SEND -> 玩家 %s: %d 条消息", player_id, len(encoded_messages))
+                send_frame(conn, encode_batch_frame(encoded_messages))
+            except Exception as e:
+                logger.error(f"发送消息给玩家 {player_id} 失败: {e}")
+                disconnected_players.append(player_id)
+
+        for p_id in disconnected_players:
+            self.remove_player(p_id)
+
     def broadcast_game_state(self):
-        """广播当前游戏状态。"""
-        should_broadcast = False
+        """广播当前游戏状态（按玩家定制）。
+
+        在一次加锁中生成所有玩家的 state（公共部分只生成一次）并复制连接表，之后发送时不再加锁。
+        与上次发给该玩家的 state 完全相同时（如对方选择"过"、动作无效被拒绝）跳过该玩家。
+        """
         with self._lock:
-            if not self._shutdown_requested.is_set() and self._game_started_actual and self.game and self.game.game_state == "playing":
-                should_broadcast = True
-        if should_broadcast:
-            self.broadcast_message({"type": "game_state", "state": "placeholder"}) # placeholder 会被定制替换
+            if self._shutdown_requested.is_set() or not self.clients: return
+            if not (self._game_started_actual and self.game and self.game.game_state == "playing"): return
+            player_states = self.game.get_states_for_all_players()
+            clients_copy = self.clients.copy()
+
+        disconnected_players = []
+        for player_id, conn in clients_copy.items():
+            player_state = player_states.get(player_id)
+            if player_state is None:
+                logger.debug("跳过向玩家 %s 广播 game_state (无法获取状态)。", player_id)
+                continue
+            message = {"type": "game_state", "state": player_state}
+            encoded_message = encode_json_bytes(message)
+            if self._last_state_bytes.get(player_id) == encoded_message:
+                logger.debug("玩家 %s 的 game_state 未变化，跳过广播。", player_id)
+                continue
+            self._last_state_bytes[player_id] = encoded_message
+            if self._queue_outgoing(player_id, conn, message, encoded_message):
+                continue
+            try:
+                logger.debug("BROADCAST -> 玩家 %s: 类型=game_state", player_id)
+                send_frame(conn, encode_batch_frame((encoded_message,)))
+            except Exception as e:
+                logger.error(f"广播游戏状态给玩家 {self.get_player_name_from_id_unsafe(player_id)} ({player_id}) 失败: {e}")
+                disconnected_players.append(player_id)
+
+        if disconnected_players:
+            logger.warning(f"广播后将移除断开连接的玩家: {disconnected_players}")
+            for p_id in disconnected_players:
+                self.remove_player(p_id)
 
     def remove_player(self, player_id):
         """从服务器状态中移除玩家。"""
@@ -492,9 +644,9 @@ class MahjongServer:
         player_name_log = f"玩家 {player_id}" # 默认日志名
         game_should_end_due_to_disconnect = False
 
-        logger.debug(f"尝试移除玩家 {player_id}，获取锁...")
+        logger.debug("尝试移除玩家 %s，获取锁...", player_id)
         with self._lock:
-            logger.debug(f"移除玩家 {player_id} - 获取到锁。")
+            logger.debug("移除玩家 %s - 获取到锁。", player_id)
             if self._shutdown_requested.is_set():
                 logger.info(f"忽略移除玩家 {player_id} 请求，服务器正在关闭。")
                 return
@@ -509,11 +661,9 @@ class MahjongServer:
             if player_id in self.clients:
                 logger.info(f"正在移除玩家 {player_name_log} ({player_id})...")
                 conn = self.clients.pop(player_id, None)
-                # 从 self.players (Player 对象列表) 移除
-                original_player_count = len(self.players)
-                self.players = [p for p in self.players if p.player_id != player_id]
-                if len(self.players) < original_player_count:
-                    logger.debug(f"已从服务器玩家对象列表 self.players 移除 {player_name_log}")
+                # 从 self._players_by_id 移除
+                if self._players_by_id.pop(player_id, None) is not None:
+                    logger.debug("已从服务器玩家表 self._players_by_id 移除 %s", player_name_log)
 
                 if conn:
                     try: conn.shutdown(socket.SHUT_RDWR)
@@ -524,20 +674,20 @@ class MahjongServer:
                 if self.game:
                     if self._game_started_actual and self.game.game_state == "playing" and player_obj_to_remove:
                         logger.warning(f"玩家 {player_name_log} 在游戏进行中断开连接，将结束游戏。")
-                        self.game.end_game(f"玩家 {player_name_log} 断开连接")
+                        # 交给游戏主循环结束游戏，不在此处（可能是客户端线程）修改 Game
+                        self._input_queue.put_nowait(("disconnect", player_id, {"player_name": player_name_log}))
                         game_should_end_due_to_disconnect = True # 标记游戏应因此结束
                     elif not self._game_started_actual and player_obj_to_remove:
                          logger.info(f"玩家 {player_name_log} 在等待阶段断开连接。")
                          # 如果在Game对象中也有这个player，也需要移除
-                         if self.game and player_obj_to_remove in self.game.players:
-                             self.game.players.remove(player_obj_to_remove)
-                             logger.debug(f"已从游戏实例的玩家列表移除 {player_name_log}")
+                         if self.game and self.game.remove_waiting_player(player_obj_to_remove):
+                             logger.debug("已从游戏实例的玩家列表移除 %s", player_name_log)
 
 
             else:
                 logger.warning(f"尝试移除玩家 {player_id}，但该玩家不在当前连接列表中。")
                 return
-        logger.debug(f"移除玩家 {player_id} - 释放锁。")
+        logger.debug("移除玩家 %s - 释放锁。", player_id)
         # 游戏结束后的服务器状态重置由 game_loop 检测到 "finished" 状态后处理
 
     def _reset_server_state_internal(self):
@@ -547,8 +697,9 @@ class MahjongServer:
         if clients_to_close_sockets: logger.info(f"准备关闭 {len(clients_to_close_sockets)} 个剩余客户端连接...")
 
         self.clients = {}
-        self.players = [] # 清空Player对象列表
+        self._players_by_id = {} # 清空玩家表
         self._player_counter = 0 # 可以考虑是否重置ID计数器
+        self._last_state_bytes = {}
         if self.game:
             # Game实例可能还包含玩家列表，如果Game实例的清理逻辑不完善，这里可以额外清一下
             # self.game.players = [] # 或者依赖 self.game = None
@@ -556,7 +707,7 @@ class MahjongServer:
         self.game = None
         self._game_instance_exists = False
         self._game_started_actual = False
-        self._pending_client_input = None
+        self._input_queue = queue.Queue()  # 丢弃尚未处理的输入
 
         for sock in clients_to_close_sockets:
             try: sock.shutdown(socket.SHUT_RDWR)
@@ -565,7 +716,7 @@ class MahjongServer:
             except Exception: pass
         logger.warning("服务器状态已重置。游戏实例已清除。")
         # 提示用户服务器需要重新配置 (或自动重新配置)
-        print("\n服务器已重置。如需开始新游戏，请重新运行服务器或实现重新配置逻辑。")
+        logger.info("服务器已重置。如需开始新游戏，请重新运行服务器或实现重新配置逻辑。")
         # 当前实现下，服务器将无法再次启动游戏，因为 configure_game 只在开始时运行一次。
         # 可以选择在这里再次调用 self.configure_game() 来允许连续游戏，
         # 或者让服务器在run()方法结束后彻底退出。
@@ -575,11 +726,7 @@ class MahjongServer:
 
     def get_player_by_id_internal(self, player_id):
         """根据ID获取玩家对象（假定锁已被持有）。"""
-        if player_id is None: return None
-        for player in self.players: # self.players 现在是 Player 对象的列表
-            if player.player_id == player_id:
-                return player
-        return None
+        return self._players_by_id.get(player_id)
 
     def get_player_name_from_id_unsafe(self, player_id):
         """获取玩家名称（主要用于锁外的日志记录）。"""
@@ -597,6 +744,7 @@ if __name__ == "__main__":
     # log_level = logging.DEBUG
     log_format = '%(asctime)s - %(levelname)-8s - %(name)-15s - %(threadName)-18s - %(message)s'
     logging.basicConfig(level=log_level, format=log_format)
+    threading.stack_size(THREAD_STACK_SIZE)
 
     server = MahjongServer()
     try:
@@ -0,0 +1,85 @@
+# mahjong_solver.py
+# 胡牌判定的核心计算：只处理牌编号计数向量 (下标为 mahjong_common.TILE_TO_ID 中的编号，值为张数)，
+# 与玩家、游戏状态无关，供 mahjong_game 调用
+
+from functools import lru_cache
+from mahjong_common import NUM_TILE_KINDS, NUM_SUIT_KINDS
+
+
+def _remove_melds(counts, first_tile):
+    """从 first_tile 起把 counts 中的牌逐一拆成刻子/顺子，原地扣除、回溯时恢复，不分配新的计数向量。"""
+    while first_tile < NUM_TILE_KINDS and not counts[first_tile]:
+        first_tile += 1
+    if first_tile == NUM_TILE_KINDS:
+        return True
+
+    can_start_sequence = first_tile < NUM_SUIT_KINDS and first_tile % 9 <= 6
+    if counts[first_tile] < 3 and not can_start_sequence:  # 字牌或 8、9 点凑不成顺子，只能做刻子
+        return False
+
+    # 1. 尝试移除刻子 (AAA)
+    if counts[first_tile] >= 3:
+        counts[first_tile] -= 3
+        melds_ok = _remove_melds(counts, first_tile)
+        counts[first_tile] += 3
+        if melds_ok:
+            return True
+
+    # 2. 尝试移除顺子 (ABC)，只有万/条/筒的 1-7 能作为顺子的第一张
+    if can_start_sequence and counts[first_tile + 1] and counts[first_tile + 2]:
+        counts[first_tile] -= 1
+        counts[first_tile + 1] -= 1
+        counts[first_tile + 2] -= 1
+        melds_ok = _remove_melds(counts, first_tile)
+        counts[first_tile] += 1
+        counts[first_tile + 1] += 1
+        counts[first_tile + 2] += 1
+        if melds_ok:
+            return True
+    return False
+
+
+@lru_cache(maxsize=1 << 16)
+def can_form_melds(counts):
+    """counts 为计数向量 (bytes)，判断其中的牌能否全部组成刻子或顺子。
+
+    同一计数向量在不同的候选牌、不同玩家之间会反复出现，因此按计数向量缓存结果。
+    """
+    # 总张数必须是 3 的倍数；字牌不能组成顺子，每种字牌只能是 0 或 3 张
+    if sum(counts) % 3:
+        return False
+    for tile in range(NUM_SUIT_KINDS, NUM_TILE_KINDS):
+        if counts[tile] % 3:
+            return False
+    return _remove_melds(bytearray(counts), 0)
+
+
+def check_standard_win(counts):
+    """counts 为全部牌的计数向量 (bytearray)，判断能否组成 m 个面子 + 1 个将。
+
+    逐个尝试将牌时在 counts 上原地扣除再恢复，不复制计数向量；返回时 counts 保持不变。
+    """
+    total_tiles = sum(counts)
+    if total_tiles % 3 != 2:
+        return False
+
+    # 字牌只能做刻子或将：张数除 3 余 1 的字牌无解；余 2 的字牌必须做将，且最多只能有一种
+    honour_pair = None
+    for tile in range(NUM_SUIT_KINDS, NUM_TILE_KINDS):
+        remainder = counts[tile] % 3
+        if remainder == 1:
+            return False
+        if remainder == 2:
+            if honour_pair is not None:
+                return False
+            honour_pair = tile
+    pair_candidates = range(NUM_TILE_KINDS) if honour_pair is None else (honour_pair,)
+
+    for pair_tile in pair_candidates:
+        if counts[pair_tile] >= 2:
+            counts[pair_tile] -= 2
+            melds_ok = can_form_melds(bytes(counts))
+            counts[pair_tile] += 2
+            if melds_ok:
+                return True
+    return False